@@ -0,0 +1,113 @@
+import asyncio
+
+from fastapi import WebSocket
+
+from .presence import presence
+
+# Seconds between protocol-level pings sent by uvicorn (see main.py), sockets
+# that don't answer within HEARTBEAT_TIMEOUT are closed by uvicorn
+HEARTBEAT_INTERVAL = 20
+HEARTBEAT_TIMEOUT = 20
+# Seconds an app-level "ping" frame may take to send before the socket is
+# dropped. Only sent to clients that asked for them, browsers can't see
+# protocol-level pings.
+HEARTBEAT_SEND_TIMEOUT = 2
+MAX_CONNECTIONS = 10_000
+MAX_CONNECTIONS_PER_USER = 10
+
+
+class SingleConnection:
+    __slots__ = ("user_id", "websocket", "heartbeat", "task")
+
+    def __init__(self, user_id: int, websocket: WebSocket, heartbeat: bool = False):
+        self.user_id = user_id
+        self.websocket = websocket
+        # Client opted in to app-level "ping" frames
+        self.heartbeat = heartbeat
+        # Task serving the socket, cancelled when the socket is reaped
+        self.task = asyncio.current_task()
+
+
+class ConnectionManager:
+    def __init__(self):
+        self.active_connections: dict[int, list[SingleConnection]] = {}
+        self.connection_count = 0
+        self.heartbeat_task: asyncio.Task | None = None
+
+    def append_connection(
+        self, user_id: int, websocket: WebSocket, heartbeat: bool = False
+    ):
+        user_connections = self.active_connections.get(user_id, [])
+        if (
+            self.connection_count >= MAX_CONNECTIONS
+            or len(user_connections) >= MAX_CONNECTIONS_PER_USER
+        ):
+            return None
+
+        connection = SingleConnection(
+            user_id=user_id, websocket=websocket, heartbeat=heartbeat
+        )
+        user_connections.append(connection)
+        self.active_connections[user_id] = user_connections
+        self.connection_count += 1
+        if len(user_connections) == 1:
+            presence.mark_online(user_id)
+        return connection
+
+    async def connect(
+        self, user_id: int, websocket: WebSocket, heartbeat: bool = False
+    ):
+        await websocket.accept()
+        return self.append_connection(user_id, websocket, heartbeat)
+
+    def disconnect(self, connection: SingleConnection):
+        user_connections = self.active_connections.get(connection.user_id)
+        if not user_connections or connection not in user_connections:
+            return
+
+        user_connections.remove(connection)
+        self.connection_count -= 1
+        if not user_connections:
+            del self.active_connections[connection.user_id]
+            presence.mark_offline(connection.user_id)
+
+    def user_connections(self, user_id: int) -> list[SingleConnection]:
+        return self.active_connections.get(user_id, [])
+
+    async def reap(self, connection: SingleConnection):
+        self.disconnect(connection)
+        task = connection.task
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        try:
+            await connection.websocket.close()
+        except Exception:
+            pass
+
+    async def ping(self, connection: SingleConnection):
+        try:
+            await asyncio.wait_for(
+                connection.websocket.send_text("ping"), HEARTBEAT_SEND_TIMEOUT
+            )
+        except Exception:
+            await self.reap(connection)
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            # Concurrently, so a stuck socket only holds up itself
+            await asyncio.gather(
+                *(
+                    self.ping(connection)
+                    for user_connections in list(self.active_connections.values())
+                    for connection in user_connections
+                    if connection.heartbeat
+                )
+            )
+
+    def start_heartbeat(self):
+        if self.heartbeat_task is None or self.heartbeat_task.done():
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
+
+connections = ConnectionManager()
@@ -1,7 +1,18 @@
+from datetime import datetime
+
+from sqlalchemy import exists, func, insert, tuple_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from sqlalchemy.sql import or_, and_
+from sqlalchemy.sql import and_
 
 from . import models, schemas
+from .database import reads_replica, record_write
+from .friend_graph import friend_graph
+from .message_cache import CONVERSATION_CACHE_SIZE, message_cache
+from .sharding import merge_by_time, shards
+
+# Rows fetched per round trip when streaming through a server-side cursor
+STREAM_BATCH_SIZE = 500
 
 
 def get_user(db: Session, user_id: int):
@@ -30,12 +41,187 @@ def get_many_users(db: Session, how_many: int):
     return db.query(models.User).limit(how_many).all()
 
 
+def get_users_by_ids(db: Session, user_ids: list[int]):
+    if not user_ids:
+        return {}
+    users = db.query(models.User).filter(models.User.id.in_(user_ids)).all()
+    return {user.id: user for user in users}
+
+
+def get_users_online(db: Session, user_ids: list[int]):
+    if not user_ids:
+        return {}
+    return dict(
+        db.query(models.User.id, models.User.is_online)
+        .filter(models.User.id.in_(user_ids))
+        .all()
+    )
+
+
+def update_presence(
+    db: Session,
+    worker_id: str,
+    online_ids: list[int],
+    offline_ids: list[int],
+    seen_at: datetime,
+    expired_before: datetime,
+):
+    # Refreshes and updates this worker's presence rows, drops the expired rows
+    # of dead workers, then recomputes users.is_online from the rows left.
+    # Returns {user id: is_online} for every user whose state may have changed.
+    worker_rows = db.query(models.UserPresence).filter(
+        models.UserPresence.worker_id == worker_id
+    )
+    worker_rows.update(
+        {models.UserPresence.seen_at: seen_at}, synchronize_session=False
+    )
+    if offline_ids:
+        worker_rows.filter(models.UserPresence.user_id.in_(offline_ids)).delete(
+            synchronize_session=False
+        )
+    if online_ids:
+        known_ids = {
+            user_id
+            for (user_id,) in worker_rows.filter(
+                models.UserPresence.user_id.in_(online_ids)
+            ).with_entities(models.UserPresence.user_id)
+        }
+        new_rows = [
+            {"user_id": user_id, "worker_id": worker_id, "seen_at": seen_at}
+            for user_id in online_ids
+            if user_id not in known_ids
+        ]
+        if new_rows:
+            db.execute(insert(models.UserPresence), new_rows)
+
+    expired_rows = db.query(models.UserPresence).filter(
+        models.UserPresence.seen_at < expired_before
+    )
+    changed_ids = {
+        user_id
+        for (user_id,) in expired_rows.with_entities(models.UserPresence.user_id)
+    }
+    if changed_ids:
+        expired_rows.delete(synchronize_session=False)
+    changed_ids.update(online_ids)
+    changed_ids.update(offline_ids)
+    if not changed_ids:
+        db.commit()
+        return {}
+
+    changed_users = db.query(models.User).filter(models.User.id.in_(changed_ids))
+    changed_users.update(
+        {
+            models.User.is_online: exists().where(
+                models.UserPresence.user_id == models.User.id
+            )
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+    return dict(changed_users.with_entities(models.User.id, models.User.is_online))
+
+
+# Messages live on the shard of their conversation (see sharding.py), the
+# functions below route there themselves and take the main session as db
+def query_user_received_messages(db: Session, user_id: int):
+    return (
+        db.query(models.Message)
+        .filter(models.Message.receiver_id == user_id)
+        .order_by(models.Message.created_datetime, models.Message.id)
+    )
+
+
+def query_user_sent_messages(db: Session, user_id: int):
+    return (
+        db.query(models.Message)
+        .filter(models.Message.sender_id == user_id)
+        .order_by(models.Message.created_datetime, models.Message.id)
+    )
+
+
 def get_user_received_messages(db: Session, user_id: int):
-    return db.query(models.Message).filter(models.Message.receiver_id == user_id).all()
+    with shards.all_sessions(db) as shard_dbs:
+        return list(
+            merge_by_time(
+                query_user_received_messages(db=shard_db, user_id=user_id).all()
+                for shard_db in shard_dbs
+            )
+        )
+
+
+def get_users_with_messages(db: Session, users: list[models.User]):
+    # schemas.User for each user with their messages from every shard, the
+    # User.sent_messages/received_messages relationships only see the main DB
+    user_ids = [user.id for user in users]
+    sent_messages = {user_id: [] for user_id in user_ids}
+    received_messages = {user_id: [] for user_id in user_ids}
+    if user_ids:
+        with shards.all_sessions(db) as shard_dbs:
+            sent_results = [
+                shard_db.query(models.Message)
+                .filter(models.Message.sender_id.in_(user_ids))
+                .order_by(models.Message.created_datetime, models.Message.id)
+                .all()
+                for shard_db in shard_dbs
+            ]
+            received_results = [
+                shard_db.query(models.Message)
+                .filter(models.Message.receiver_id.in_(user_ids))
+                .order_by(models.Message.created_datetime, models.Message.id)
+                .all()
+                for shard_db in shard_dbs
+            ]
+        for message in merge_by_time(sent_results):
+            sent_messages[message.sender_id].append(message)
+        for message in merge_by_time(received_results):
+            received_messages[message.receiver_id].append(message)
+
+    return [
+        schemas.User(
+            id=user.id,
+            user_email=user.user_email,
+            user_name=user.user_name,
+            is_online=user.is_online,
+            sent_messages=sent_messages[user.id],
+            received_messages=received_messages[user.id],
+        )
+        for user in users
+    ]
 
 
 def get_user_sent_messages(db: Session, user_id: int):
-    return db.query(models.Message).filter(models.Message.sender_id == user_id).all()
+    with shards.all_sessions(db) as shard_dbs:
+        return list(
+            merge_by_time(
+                query_user_sent_messages(db=shard_db, user_id=user_id).all()
+                for shard_db in shard_dbs
+            )
+        )
+
+
+def iter_user_received_messages(
+    db: Session, user_id: int, batch_size: int = STREAM_BATCH_SIZE
+):
+    with shards.all_sessions(db) as shard_dbs:
+        yield from merge_by_time(
+            query_user_received_messages(db=shard_db, user_id=user_id).yield_per(
+                batch_size
+            )
+            for shard_db in shard_dbs
+        )
+
+
+def iter_user_sent_messages(
+    db: Session, user_id: int, batch_size: int = STREAM_BATCH_SIZE
+):
+    with shards.all_sessions(db) as shard_dbs:
+        yield from merge_by_time(
+            query_user_sent_messages(db=shard_db, user_id=user_id).yield_per(
+                batch_size
+            )
+            for shard_db in shard_dbs
+        )
 
 
 def create_registered_user(db: Session, email: str, username: str):
@@ -56,48 +242,307 @@ def create_registered_user(db: Session, email: str, username: str):
 
 
 def create_message(
-    db: Session, message: schemas.MessageCreate, sender_id: int, receiver_id: int
+    db: Session,
+    message: schemas.MessageCreate,
+    sender_id: int,
+    receiver_id: int,
+    idempotency_key: str | None = None,
 ):
     db_message = models.Message(
-        content=message.content, sender_id=sender_id, receiver_id=receiver_id
+        content=message.content,
+        sender_id=sender_id,
+        receiver_id=receiver_id,
+        idempotency_key=idempotency_key,
     )
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    with shards.session_for(db, sender_id, receiver_id) as message_db:
+        message_db.add(db_message)
+        message_db.commit()
+        message_db.refresh(db_message)
+    record_write(sender_id)
+    message_cache.append(message_as_dict(db_message))
     return db_message
 
 
-def get_friend_messages_sorted(
+def get_message_by_idempotency_key(
+    db: Session, sender_id: int, receiver_id: int, idempotency_key: str
+):
+    with shards.session_for(db, sender_id, receiver_id) as message_db:
+        return (
+            message_db.query(models.Message)
+            .filter(
+                models.Message.sender_id == sender_id,
+                models.Message.idempotency_key == idempotency_key,
+            )
+            .first()
+        )
+
+
+def create_message_idempotent(
     db: Session,
-    user_id: int,
-    friend_id: int,
+    message: schemas.MessageCreate,
+    sender_id: int,
+    receiver_id: int,
+    idempotency_key: str,
 ):
-    all_messages = (
+    # Returns (message, created), the original message when the key was
+    # already used by this sender
+    with shards.session_for(db, sender_id, receiver_id) as message_db:
+        db_message = get_message_by_idempotency_key(
+            db=message_db,
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            idempotency_key=idempotency_key,
+        )
+        if db_message is not None:
+            return db_message, False
+
+        try:
+            db_message = create_message(
+                db=message_db,
+                message=message,
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                idempotency_key=idempotency_key,
+            )
+        except IntegrityError:
+            # A concurrent retry inserted it first
+            message_db.rollback()
+            db_message = get_message_by_idempotency_key(
+                db=message_db,
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                idempotency_key=idempotency_key,
+            )
+            if db_message is None:
+                raise
+            return db_message, False
+        return db_message, True
+
+
+def message_as_dict(db_message: models.Message):
+    return {
+        column.name: getattr(db_message, column.name)
+        for column in models.Message.__table__.columns
+    }
+
+
+def get_messages_by_idempotency_keys(db: Session, keys: list[tuple[int, str]]):
+    if not keys:
+        return {}
+    db_messages = (
         db.query(models.Message)
         .filter(
-            or_(
-                and_(
-                    models.Message.sender_id == user_id,
-                    models.Message.receiver_id == friend_id,
-                ),
-                and_(
-                    models.Message.sender_id == friend_id,
-                    models.Message.receiver_id == user_id,
-                ),
-            )
+            tuple_(models.Message.sender_id, models.Message.idempotency_key).in_(keys)
         )
-        .order_by(models.Message.created_datetime.asc())
         .all()
     )
-    return all_messages
+    return {
+        (db_message.sender_id, db_message.idempotency_key): message_as_dict(db_message)
+        for db_message in db_messages
+    }
+
+
+def create_messages(db: Session, messages: list[dict]):
+    # Multi-row insert of {"content", "sender_id", "receiver_id"} dicts with an
+    # optional "idempotency_key". Returns (message dict, created) pairs in the
+    # same order, already used keys resolve to the original message.
+    if not shards.enabled:
+        return insert_messages(db=db, messages=messages)
+
+    # One insert per shard, results put back in the original order
+    shard_positions: dict[int, list[int]] = {}
+    for position, message in enumerate(messages):
+        index = shards.shard_index(message["sender_id"], message["receiver_id"])
+        shard_positions.setdefault(index, []).append(position)
+
+    results = [None] * len(messages)
+    for positions in shard_positions.values():
+        first_message = messages[positions[0]]
+        with shards.session_for(
+            db, first_message["sender_id"], first_message["receiver_id"]
+        ) as message_db:
+            shard_results = insert_messages(
+                db=message_db, messages=[messages[position] for position in positions]
+            )
+        for position, result in zip(positions, shard_results):
+            results[position] = result
+    return results
 
 
-def get_friend_last_message(
+def insert_messages(db: Session, messages: list[dict]):
+    # create_messages for messages that all live in db
+    if not messages:
+        return []
+
+    keys = [
+        (message["sender_id"], message["idempotency_key"])
+        for message in messages
+        if message.get("idempotency_key") is not None
+    ]
+    existing = get_messages_by_idempotency_keys(db=db, keys=keys)
+    # A key repeated within the batch is inserted once, later uses resolve to it
+    new_messages = []
+    new_keys = set()
+    for message in messages:
+        key = (message["sender_id"], message.get("idempotency_key"))
+        if key in existing or key in new_keys:
+            continue
+        if key[1] is not None:
+            new_keys.add(key)
+        new_messages.append(message)
+
+    try:
+        inserted = []
+        if new_messages and db.get_bind().dialect.full_returning:
+            result = db.execute(
+                insert(models.Message)
+                .values(new_messages)
+                .returning(*models.Message.__table__.columns)
+            )
+            inserted = [dict(row._mapping) for row in result]
+            db.commit()
+        elif new_messages:
+            # No RETURNING (SQLite shards), insert through the ORM instead
+            db_messages = [models.Message(**message) for message in new_messages]
+            db.add_all(db_messages)
+            db.commit()
+            for db_message in db_messages:
+                db.refresh(db_message)
+            inserted = [message_as_dict(db_message) for db_message in db_messages]
+    except IntegrityError:
+        # A key raced with another insert, fall back to one message at a time
+        db.rollback()
+        results = []
+        for message in messages:
+            message_kwargs = {
+                "db": db,
+                "message": schemas.MessageCreate(content=message["content"]),
+                "sender_id": message["sender_id"],
+                "receiver_id": message["receiver_id"],
+            }
+            if message.get("idempotency_key") is None:
+                db_message, created = create_message(**message_kwargs), True
+            else:
+                db_message, created = create_message_idempotent(
+                    **message_kwargs, idempotency_key=message["idempotency_key"]
+                )
+            results.append((message_as_dict(db_message), created))
+        return results
+
+    for sender_id in {message["sender_id"] for message in new_messages}:
+        record_write(sender_id)
+    for db_message in inserted:
+        message_cache.append(db_message)
+
+    inserted_messages = iter(inserted)
+    results = []
+    for message in messages:
+        key = (message["sender_id"], message.get("idempotency_key"))
+        if key in existing:
+            results.append((existing[key], False))
+            continue
+        inserted_message = next(inserted_messages)
+        if key[1] is not None:
+            existing[key] = inserted_message
+        results.append((inserted_message, True))
+    return results
+
+
+def query_friend_messages_sorted(
+    db: Session, user_id: int, friend_id: int, newest_first: bool = False
+):
+    # Both directions in one ordered walk of ix_messages_conversation_pair,
+    # rows of one multi-row insert share created_datetime and are told apart
+    # by id
+    conversation = db.query(models.Message).filter(
+        models.conversation_low == min(user_id, friend_id),
+        models.conversation_high == max(user_id, friend_id),
+    )
+    if newest_first:
+        return conversation.order_by(
+            models.Message.created_datetime.desc(), models.Message.id.desc()
+        )
+    return conversation.order_by(models.Message.created_datetime, models.Message.id)
+
+
+def query_friend_newest_message_id(db: Session, user_id: int, friend_id: int):
+    # Freshness check for the message cache, one row read from the end of
+    # ix_messages_conversation_pair
+    return (
+        query_friend_messages_sorted(
+            db=db, user_id=user_id, friend_id=friend_id, newest_first=True
+        )
+        .with_entities(models.Message.id)
+        .limit(1)
+    )
+
+
+def get_friend_messages_sorted(
     db: Session,
     user_id: int,
     friend_id: int,
+    limit: int | None = None,
+):
+    # With a limit, only the most recent `limit` messages (oldest first),
+    # served from the message cache when the conversation is warm and its
+    # newest message is the newest in the DB. The cache is only filled from
+    # primary reads, a lagging replica would hide writes the reader just made.
+    if limit is not None and limit <= CONVERSATION_CACHE_SIZE:
+        with shards.session_for(db, user_id, friend_id) as message_db:
+            newest_id = query_friend_newest_message_id(
+                db=message_db, user_id=user_id, friend_id=friend_id
+            ).scalar()
+            cached_messages = message_cache.get_recent(
+                user_id, friend_id, limit, newest_id=newest_id
+            )
+            if cached_messages is not None:
+                return cached_messages
+
+            snapshot = message_cache.snapshot()
+            recent_messages = query_friend_messages_sorted(
+                db=message_db, user_id=user_id, friend_id=friend_id, newest_first=True
+            ).limit(CONVERSATION_CACHE_SIZE).all()[::-1]
+            from_replica = reads_replica(message_db)
+        if not from_replica:
+            message_cache.fill(
+                user_id,
+                friend_id,
+                recent_messages,
+                complete=len(recent_messages) < CONVERSATION_CACHE_SIZE,
+                snapshot=snapshot,
+            )
+        return recent_messages[-limit:] if limit else []
+
+    snapshot = message_cache.snapshot()
+    with shards.session_for(db, user_id, friend_id) as message_db:
+        all_messages = query_friend_messages_sorted(
+            db=message_db, user_id=user_id, friend_id=friend_id
+        ).all()
+        from_replica = reads_replica(message_db)
+    if not from_replica:
+        message_cache.fill(
+            user_id,
+            friend_id,
+            all_messages,
+            complete=len(all_messages) <= CONVERSATION_CACHE_SIZE,
+            snapshot=snapshot,
+        )
+    if limit is not None:
+        return all_messages[-limit:] if limit else []
+    return all_messages
+
+
+def iter_friend_messages_sorted(
+    db: Session, user_id: int, friend_id: int, batch_size: int = STREAM_BATCH_SIZE
 ):
-    last_message = (
+    with shards.session_for(db, user_id, friend_id) as message_db:
+        yield from query_friend_messages_sorted(
+            db=message_db, user_id=user_id, friend_id=friend_id
+        ).yield_per(batch_size)
+
+
+def query_friend_last_message(db: Session, user_id: int, friend_id: int):
+    return (
         db.query(models.Message)
         .filter(
             and_(
@@ -105,9 +550,30 @@ def get_friend_last_message(
                 models.Message.receiver_id == user_id,
             )
         )
-        .order_by(models.Message.created_datetime.desc())
-        .first()
+        .order_by(models.Message.created_datetime.desc(), models.Message.id.desc())
     )
+
+
+def get_friend_last_message(
+    db: Session,
+    user_id: int,
+    friend_id: int,
+):
+    # Served from the message cache when the conversation is warm and its
+    # newest message is the newest in the DB
+    with shards.session_for(db, user_id, friend_id) as message_db:
+        newest_id = query_friend_newest_message_id(
+            db=message_db, user_id=user_id, friend_id=friend_id
+        ).scalar()
+        found, last_message = message_cache.get_last_message_from(
+            friend_id, user_id, newest_id=newest_id
+        )
+        if found:
+            return last_message
+
+        last_message = query_friend_last_message(
+            db=message_db, user_id=user_id, friend_id=friend_id
+        ).first()
     return last_message
 
 
@@ -133,6 +599,7 @@ def create_friendship_request(db: Session, requester_id: int, adressee_id: int):
     db.add(db_new_friendship_status)
     db.commit()
     db.refresh(db_new_friendship_status)
+    record_write(requester_id)
 
     return db_new_friendship, db_new_friendship_status
 
@@ -146,65 +613,28 @@ def get_friendship(db: Session, first_user: int, second_user: int):
 
 
 def get_user_friends(db: Session, this_user: int):
-    friendships = (
-        db.query(models.Friendship)
-        .filter(
-            (models.Friendship.adressee_id == this_user)
-            | (models.Friendship.requester_id == this_user)
-        )
+    friendship_statuses = (
+        query_latest_friendship_statuses(db=db, user_id=this_user)
+        .filter(models.FriendshipStatus.status_code.in_(("A", "B")))
         .all()
     )
-    if not friendships:
-        return []
-
-    friends = []
-    for friendship in friendships:
-        most_recent_friendship_status = (
-            db.query(models.FriendshipStatus)
-            .filter(
-                models.FriendshipStatus.adressee_id == friendship.adressee_id,
-                models.FriendshipStatus.requester_id == friendship.requester_id,
-            )
-            .order_by(models.FriendshipStatus.created_datetime.desc())
-            .first()
-        )
-        if (
-            most_recent_friendship_status.status_code == "A"
-            or most_recent_friendship_status.status_code == "B"
-        ):
-            # friendships_accepted.append(most_recent_friendship_status)
-            friend_id = (
-                lambda this_user_id: friendship.requester_id
-                if this_user_id == friendship.adressee_id
-                else friendship.adressee_id
-            )
-            friends.append(
-                db.query(models.User)
-                .filter(models.User.id == friend_id(this_user))
-                .first()
-            )
-    return friends
+    friend_ids = [
+        status.requester_id if status.adressee_id == this_user else status.adressee_id
+        for status in friendship_statuses
+    ]
+    users = get_users_by_ids(db=db, user_ids=friend_ids)
+    return [users[friend_id] for friend_id in friend_ids if friend_id in users]
 
 
 def get_users_who_requested_friends_to_this_user(db: Session, this_user: int):
-    friendships = (
-        db.query(models.Friendship)
-        .filter(models.Friendship.adressee_id == this_user)
-        .all()
-    )
+    friendships = query_friendships_to_this_user(db=db, this_user=this_user).all()
     if not friendships:
         return []
 
     friends = []
     for friendship in friendships:
-        most_recent_friendship_status = (
-            db.query(models.FriendshipStatus)
-            .filter(
-                models.FriendshipStatus.adressee_id == friendship.adressee_id,
-                models.FriendshipStatus.requester_id == friendship.requester_id,
-            )
-            .order_by(models.FriendshipStatus.created_datetime.desc())
-            .first()
+        most_recent_friendship_status = get_most_recent_friendship_status(
+            db=db, friendship=friendship
         )
         if most_recent_friendship_status.status_code == "R":
             friend_id = (
@@ -220,39 +650,44 @@ def get_users_who_requested_friends_to_this_user(db: Session, this_user: int):
     return friends
 
 
-def get_most_recent_friendship_status(db: Session, friendship: models.Friendship):
-    friendship_status = (
+def query_most_recent_friendship_status(
+    db: Session, requester_id: int, adressee_id: int
+):
+    return (
         db.query(models.FriendshipStatus)
         .filter(
-            models.FriendshipStatus.adressee_id == friendship.adressee_id,
-            models.FriendshipStatus.requester_id == friendship.requester_id,
+            models.FriendshipStatus.adressee_id == adressee_id,
+            models.FriendshipStatus.requester_id == requester_id,
         )
         .order_by(models.FriendshipStatus.created_datetime.desc())
-        .first()
     )
 
+
+def get_most_recent_friendship_status(db: Session, friendship: models.Friendship):
+    friendship_status = query_most_recent_friendship_status(
+        db=db,
+        requester_id=friendship.requester_id,
+        adressee_id=friendship.adressee_id,
+    ).first()
+
     return friendship_status
 
 
-def get_friendship_requests_to_this_user(db: Session, this_user: int):
-    friendships = (
-        db.query(models.Friendship)
-        .filter(models.Friendship.adressee_id == this_user)
-        .all()
+def query_friendships_to_this_user(db: Session, this_user: int):
+    return db.query(models.Friendship).filter(
+        models.Friendship.adressee_id == this_user
     )
+
+
+def get_friendship_requests_to_this_user(db: Session, this_user: int):
+    friendships = query_friendships_to_this_user(db=db, this_user=this_user).all()
     if not friendships:
         return []
 
     friendship_requests = []
     for friendship in friendships:
-        most_recent_friendship_status = (
-            db.query(models.FriendshipStatus)
-            .filter(
-                models.FriendshipStatus.adressee_id == friendship.adressee_id,
-                models.FriendshipStatus.requester_id == friendship.requester_id,
-            )
-            .order_by(models.FriendshipStatus.created_datetime.desc())
-            .first()
+        most_recent_friendship_status = get_most_recent_friendship_status(
+            db=db, friendship=friendship
         )
         if most_recent_friendship_status.status_code == "R":
             friendship_requests.append(most_recent_friendship_status)
@@ -275,6 +710,7 @@ def accept_friendship_request(db: Session, this_user: int, other_user: int):
     db.add(db_new_friendship_status)
     db.commit()
     db.refresh(db_new_friendship_status)
+    update_friend_graph(this_user, other_user, "A")
 
     return db_new_friendship_status
 
@@ -294,6 +730,7 @@ def deny_friendship_request(db: Session, this_user: int, other_user: int):
     db.add(db_new_friendship_status)
     db.commit()
     db.refresh(db_new_friendship_status)
+    update_friend_graph(this_user, other_user, "D")
 
     return db_new_friendship_status
 
@@ -323,13 +760,226 @@ def block_friendship(db: Session, this_user: int, other_user: int):
     db.add(db_new_friendship_status)
     db.commit()
     db.refresh(db_new_friendship_status)
+    update_friend_graph(this_user, other_user, "B")
 
     return db_new_friendship_status
 
 
+def query_latest_friendship_statuses(
+    db: Session,
+    pairs: list[tuple[int, int]] | None = None,
+    user_id: int | None = None,
+):
+    # Most recent status of every (requester_id, adressee_id) pair, or only of
+    # the given pairs / of the pairs user_id is part of
+    latest = db.query(
+        models.FriendshipStatus.requester_id,
+        models.FriendshipStatus.adressee_id,
+        func.max(models.FriendshipStatus.created_datetime).label("created_datetime"),
+    )
+    if user_id is not None:
+        latest = latest.filter(
+            (models.FriendshipStatus.requester_id == user_id)
+            | (models.FriendshipStatus.adressee_id == user_id)
+        )
+    if pairs is not None:
+        latest = latest.filter(
+            tuple_(
+                models.FriendshipStatus.requester_id,
+                models.FriendshipStatus.adressee_id,
+            ).in_(pairs)
+        )
+    latest = latest.group_by(
+        models.FriendshipStatus.requester_id, models.FriendshipStatus.adressee_id
+    ).subquery()
+
+    return db.query(models.FriendshipStatus).join(
+        latest,
+        and_(
+            models.FriendshipStatus.requester_id == latest.c.requester_id,
+            models.FriendshipStatus.adressee_id == latest.c.adressee_id,
+            models.FriendshipStatus.created_datetime == latest.c.created_datetime,
+        ),
+    )
+
+
+def get_latest_friendship_statuses(db: Session, pairs: list[tuple[int, int]]):
+    if not pairs:
+        return {}
+
+    friendship_statuses = query_latest_friendship_statuses(db=db, pairs=pairs).all()
+    return {
+        (status.requester_id, status.adressee_id): status
+        for status in friendship_statuses
+    }
+
+
+def are_friends(db: Session, this_user: int, other_user: int) -> bool:
+    statuses = get_latest_friendship_statuses(
+        db=db, pairs=[(this_user, other_user), (other_user, this_user)]
+    )
+    return any(status.status_code == "A" for status in statuses.values())
+
+
+def get_accepted_friendship_pairs(db: Session):
+    return (
+        query_latest_friendship_statuses(db=db)
+        .filter(models.FriendshipStatus.status_code == "A")
+        .with_entities(
+            models.FriendshipStatus.requester_id, models.FriendshipStatus.adressee_id
+        )
+        .all()
+    )
+
+
+# Full-table rebuild, kept off the request path by FriendGraph.refresh
+def load_friend_graph(db: Session):
+    friend_graph.rebuild(lambda: get_accepted_friendship_pairs(db=db))
+    return friend_graph
+
+
+def get_mutual_friend_count(db: Session, this_user: int, other_user: int):
+    return friend_graph.mutual_friend_count(this_user, other_user)
+
+
+def get_friendship_counterpart_ids(db: Session, this_user: int) -> set[int]:
+    # Everyone this_user has a friendship with, in any status
+    friendships = (
+        db.query(models.Friendship.requester_id, models.Friendship.adressee_id)
+        .filter(
+            (models.Friendship.requester_id == this_user)
+            | (models.Friendship.adressee_id == this_user)
+        )
+        .all()
+    )
+    return {
+        requester_id if adressee_id == this_user else adressee_id
+        for requester_id, adressee_id in friendships
+    }
+
+
+def get_friend_suggestions(db: Session, this_user: int, how_many: int):
+    # The graph only knows accepted friendships, pending, denied and blocked
+    # ones are filtered out here
+    excluded_ids = get_friendship_counterpart_ids(db=db, this_user=this_user)
+    suggestions = [
+        (user_id, mutual_friend_count)
+        for user_id, mutual_friend_count in friend_graph.suggestions(
+            this_user, how_many + len(excluded_ids)
+        )
+        if user_id not in excluded_ids
+    ][:how_many]
+    users = get_users_by_ids(db=db, user_ids=[user_id for user_id, _ in suggestions])
+    return [
+        (users[user_id], mutual_friend_count)
+        for user_id, mutual_friend_count in suggestions
+        if user_id in users
+    ]
+
+
+def update_friend_graph(this_user: int, other_user: int, status_code: str):
+    record_write(this_user)
+    if status_code == "A":
+        friend_graph.add_friendship(this_user, other_user)
+    else:
+        friend_graph.remove_friendship(this_user, other_user)
+
+
+def set_friendship_statuses(
+    db: Session,
+    this_user: int,
+    other_users: list[int],
+    status_code: str,
+    required_status_codes: set[str] | None = None,
+):
+    # Writes one status row per user in a single multi-row insert. Returns
+    # (new statuses, invalid user ids); nothing is written if any id is invalid.
+    other_users = list(dict.fromkeys(other_users))
+    pairs = [(other_user, this_user) for other_user in other_users]
+    if status_code == "B":
+        # Either side can block, regardless of who sent the request
+        pairs += [(this_user, other_user) for other_user in other_users]
+
+    latest_statuses = get_latest_friendship_statuses(db=db, pairs=pairs)
+
+    new_statuses = []
+    invalid_users = []
+    for other_user in other_users:
+        latest_status = latest_statuses.get((other_user, this_user))
+        if latest_status is None:
+            latest_status = latest_statuses.get((this_user, other_user))
+        if latest_status is None or (
+            required_status_codes is not None
+            and latest_status.status_code not in required_status_codes
+        ):
+            invalid_users.append(other_user)
+            continue
+
+        new_statuses.append(
+            {
+                "requester_id": latest_status.requester_id,
+                "adressee_id": latest_status.adressee_id,
+                "specifier_id": this_user,
+                "status_code": status_code,
+            }
+        )
+
+    if invalid_users or not new_statuses:
+        return [], invalid_users
+
+    if db.get_bind().dialect.full_returning:
+        result = db.execute(
+            insert(models.FriendshipStatus)
+            .values(new_statuses)
+            .returning(*models.FriendshipStatus.__table__.columns)
+        )
+        written_statuses = [dict(row._mapping) for row in result]
+    else:
+        # No RETURNING (SQLite), the timestamp is set here instead of by the
+        # server default so the written rows are known without reading back
+        created_datetime = datetime.utcnow()
+        written_statuses = [
+            {**new_status, "created_datetime": created_datetime}
+            for new_status in new_statuses
+        ]
+        db.execute(insert(models.FriendshipStatus).values(written_statuses))
+    db.commit()
+    for other_user in other_users:
+        update_friend_graph(this_user, other_user, status_code)
+
+    return written_statuses, []
+
+
+def accept_friendship_requests(db: Session, this_user: int, other_users: list[int]):
+    return set_friendship_statuses(
+        db=db,
+        this_user=this_user,
+        other_users=other_users,
+        status_code="A",
+        required_status_codes={"R"},
+    )
+
+
+def deny_friendship_requests(db: Session, this_user: int, other_users: list[int]):
+    return set_friendship_statuses(
+        db=db,
+        this_user=this_user,
+        other_users=other_users,
+        status_code="D",
+        required_status_codes={"R"},
+    )
+
+
+def block_friendships(db: Session, this_user: int, other_users: list[int]):
+    return set_friendship_statuses(
+        db=db, this_user=this_user, other_users=other_users, status_code="B"
+    )
+
+
 def delete_friendships(db: Session):
     deleted_friendship_status = db.query(models.FriendshipStatus).delete()
     deleted_friendship = db.query(models.Friendship).delete()
     db.commit()
+    friend_graph.load([])
 
     return deleted_friendship_status, deleted_friendship
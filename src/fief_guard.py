@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+from fastapi import HTTPException, status
+from fief_client import FiefAsync, FiefUserInfo
+
+# Seconds a single userinfo call to Fief may take
+FIEF_TIMEOUT = 3
+# Consecutive failures that open the circuit
+FIEF_FAILURE_THRESHOLD = 5
+# Seconds the circuit stays open before one trial call is let through
+FIEF_RECOVERY_TIMEOUT = 30
+# Seconds a cached identity is served without asking Fief again
+USERINFO_FRESH_TTL = 60
+# Seconds a cached identity may still be served while Fief is unavailable
+USERINFO_STALE_TTL = 15 * 60
+USERINFO_CACHE_SIZE = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = FIEF_FAILURE_THRESHOLD,
+        recovery_timeout: float = FIEF_RECOVERY_TIMEOUT,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if (
+            self.state == self.OPEN
+            and time.monotonic() - self.opened_at >= self.recovery_timeout
+        ):
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("Fief circuit opened after %d failures", self.failures)
+                self.times_opened += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def metrics(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+def fief_unavailable() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Authentication service unavailable",
+        headers={"Retry-After": str(FIEF_RECOVERY_TIMEOUT)},
+    )
+
+
+def is_fief_outage(error: Exception) -> bool:
+    # 4xx answers mean Fief is up and rejected the token, they are passed on
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (asyncio.TimeoutError, httpx.HTTPError))
+
+
+class GuardedFief:
+    # FiefAsync with a timeout, circuit breaker and cache around userinfo.
+    # Concurrent userinfo calls for the same token share one request.
+    # Identities are cached per token and served stale while the circuit is
+    # open, tokens are still validated locally by FiefAuth against the cached
+    # JWKS first. Everything else is passed through to the wrapped client.
+    def __init__(self, client: FiefAsync):
+        self.client = client
+        self.breaker = CircuitBreaker()
+        # token hash -> (fetched at, userinfo)
+        self.userinfo_cache: OrderedDict[str, tuple[float, FiefUserInfo]] = (
+            OrderedDict()
+        )
+        self.in_flight: dict[str, asyncio.Task] = {}
+        self.coalesced = 0
+        self.stale_served = 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def prefetch_keys(self):
+        # FiefAsync fetches the OpenID configuration and JWKS lazily, on the
+        # first authenticated request. It has no public method for this, the
+        # private ones are used here only, fief-client is pinned for them.
+        await self.client._get_openid_configuration()
+        await self.client._get_jwks()
+
+    def cached(self, key: str, max_age: float) -> FiefUserInfo | None:
+        entry = self.userinfo_cache.get(key)
+        if entry is None or time.monotonic() - entry[0] > max_age:
+            return None
+        self.userinfo_cache.move_to_end(key)
+        return entry[1]
+
+    def store(self, key: str, userinfo: FiefUserInfo):
+        self.userinfo_cache[key] = (time.monotonic(), userinfo)
+        self.userinfo_cache.move_to_end(key)
+        if len(self.userinfo_cache) > USERINFO_CACHE_SIZE:
+            self.userinfo_cache.popitem(last=False)
+
+    def serve_stale(self, key: str) -> FiefUserInfo:
+        userinfo = self.cached(key, USERINFO_STALE_TTL)
+        if userinfo is None:
+            raise fief_unavailable()
+        self.stale_served += 1
+        return userinfo
+
+    async def fetch_userinfo(self, key: str, access_token: str) -> FiefUserInfo:
+        try:
+            userinfo = await asyncio.wait_for(
+                self.client.userinfo(access_token), FIEF_TIMEOUT
+            )
+        except Exception as error:
+            if not is_fief_outage(error):
+                self.breaker.record_success()
+                raise
+            self.breaker.record_failure()
+            logger.warning("Fief userinfo failed: %r", error)
+            return self.serve_stale(key)
+        finally:
+            self.in_flight.pop(key, None)
+
+        self.breaker.record_success()
+        self.store(key, userinfo)
+        return userinfo
+
+    async def userinfo(self, access_token: str) -> FiefUserInfo:
+        key = hashlib.sha256(access_token.encode()).hexdigest()
+        userinfo = self.cached(key, USERINFO_FRESH_TTL)
+        if userinfo is not None:
+            return userinfo
+
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            if not self.breaker.allow():
+                return self.serve_stale(key)
+            task = asyncio.create_task(self.fetch_userinfo(key, access_token))
+            self.in_flight[key] = task
+        # A cancelled caller must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    def metrics(self) -> dict:
+        return {
+            **self.breaker.metrics(),
+            "in_flight": len(self.in_flight),
+            "coalesced": self.coalesced,
+            "stale_served": self.stale_served,
+            "cached_identities": len(self.userinfo_cache),
+        }
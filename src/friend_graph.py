@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Callable
+
+from starlette.concurrency import run_in_threadpool
+
+# Rebuilt from the database in the background this often, picks up friendship
+# changes made by other workers
+GRAPH_MAX_AGE = 300
+# Friends (and friends of each friend) looked at when building suggestions
+SUGGESTION_FANOUT = 200
+# Users whose mutual counts and suggestions are kept cached
+CACHED_USERS = 10_000
+CACHED_SUGGESTIONS_PER_USER = 100
+CACHED_MUTUAL_COUNTS_PER_USER = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResults:
+    __slots__ = ("mutual_counts", "suggestions")
+
+    def __init__(self):
+        self.mutual_counts: dict[int, int] = {}
+        self.suggestions: list[tuple[int, int]] | None = None
+
+
+def intersection_size(first: array, second: array) -> int:
+    i = j = count = 0
+    while i < len(first) and j < len(second):
+        if first[i] == second[j]:
+            count += 1
+            i += 1
+            j += 1
+        elif first[i] < second[j]:
+            i += 1
+        else:
+            j += 1
+    return count
+
+
+class FriendGraph:
+    def __init__(self):
+        # user id -> sorted ids of accepted friends
+        self.adjacency: dict[int, array] = {}
+        self.loaded_at: float | None = None
+        self.cache: OrderedDict[int, CachedResults] = OrderedDict()
+        self.lock = threading.RLock()
+        # (added, user id, other user id) for friendships changed while a
+        # rebuild is querying, replayed on the rebuilt graph so they aren't lost
+        self.pending_changes: list[tuple[bool, int, int]] | None = None
+        self.refresh_task: asyncio.Task | None = None
+        self.refresh_loop_task: asyncio.Task | None = None
+
+    def rebuild(self, fetch_accepted_pairs: Callable[[], list[tuple[int, int]]]):
+        with self.lock:
+            self.pending_changes = []
+        try:
+            accepted_pairs = fetch_accepted_pairs()
+        except Exception:
+            with self.lock:
+                self.pending_changes = None
+            raise
+        self.load(accepted_pairs)
+
+    def load(self, accepted_pairs: list[tuple[int, int]]):
+        adjacency: dict[int, list[int]] = {}
+        for requester_id, adressee_id in accepted_pairs:
+            adjacency.setdefault(requester_id, []).append(adressee_id)
+            adjacency.setdefault(adressee_id, []).append(requester_id)
+
+        with self.lock:
+            self.adjacency = {
+                user_id: array("i", sorted(set(friends)))
+                for user_id, friends in adjacency.items()
+            }
+            self.cache.clear()
+            self.loaded_at = time.monotonic()
+            for added, user_id, other_user_id in self.pending_changes or []:
+                self.apply_change(added, user_id, other_user_id)
+            self.pending_changes = None
+
+    async def refresh(self, load: Callable[[], object]):
+        # Runs load() (which calls rebuild) in a thread. Concurrent callers
+        # share one rebuild and the current graph is served meanwhile.
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(run_in_threadpool(load))
+        await asyncio.shield(self.refresh_task)
+
+    async def refresh_loop(self, load: Callable[[], object]):
+        while True:
+            await asyncio.sleep(GRAPH_MAX_AGE)
+            try:
+                await self.refresh(load)
+            except Exception:
+                logger.exception("Friend graph rebuild failed")
+
+    def start(self, load: Callable[[], object]):
+        if self.refresh_loop_task is None or self.refresh_loop_task.done():
+            self.refresh_loop_task = asyncio.create_task(self.refresh_loop(load))
+
+    def friends(self, user_id: int) -> array:
+        return self.adjacency.get(user_id, array("i"))
+
+    def are_friends(self, user_id: int, other_user_id: int) -> bool:
+        friends = self.friends(user_id)
+        index = bisect_left(friends, other_user_id)
+        return index < len(friends) and friends[index] == other_user_id
+
+    def invalidate(self, user_id: int, other_user_id: int):
+        # Mutual counts and suggestions within two hops of the edge change
+        for affected in (user_id, other_user_id):
+            self.cache.pop(affected, None)
+            for friend_id in self.friends(affected):
+                self.cache.pop(friend_id, None)
+
+    def add_friendship(self, user_id: int, other_user_id: int):
+        self.change(True, user_id, other_user_id)
+
+    def remove_friendship(self, user_id: int, other_user_id: int):
+        self.change(False, user_id, other_user_id)
+
+    def change(self, added: bool, user_id: int, other_user_id: int):
+        with self.lock:
+            if self.pending_changes is not None:
+                self.pending_changes.append((added, user_id, other_user_id))
+            if self.loaded_at is not None:
+                self.apply_change(added, user_id, other_user_id)
+
+    def apply_change(self, added: bool, user_id: int, other_user_id: int):
+        self.invalidate(user_id, other_user_id)
+        for a, b in ((user_id, other_user_id), (other_user_id, user_id)):
+            if added:
+                friends = self.adjacency.setdefault(a, array("i"))
+                if not self.are_friends(a, b):
+                    insort(friends, b)
+            else:
+                friends = self.friends(a)
+                index = bisect_left(friends, b)
+                if index < len(friends) and friends[index] == b:
+                    del friends[index]
+
+    def cached_results(self, user_id: int) -> CachedResults:
+        results = self.cache.get(user_id)
+        if results is None:
+            results = CachedResults()
+            self.cache[user_id] = results
+            if len(self.cache) > CACHED_USERS:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(user_id)
+        return results
+
+    def mutual_friend_count(self, user_id: int, other_user_id: int) -> int:
+        with self.lock:
+            results = self.cached_results(user_id)
+            count = results.mutual_counts.get(other_user_id)
+            if count is None:
+                count = intersection_size(
+                    self.friends(user_id), self.friends(other_user_id)
+                )
+                if len(results.mutual_counts) >= CACHED_MUTUAL_COUNTS_PER_USER:
+                    results.mutual_counts.clear()
+                results.mutual_counts[other_user_id] = count
+            return count
+
+    def suggestions(self, user_id: int, limit: int) -> list[tuple[int, int]]:
+        # Friends of friends as (user id, mutual friend count), best first
+        with self.lock:
+            results = self.cached_results(user_id)
+            if results.suggestions is None:
+                friends = self.friends(user_id)
+                candidates: dict[int, int] = {}
+                for friend_id in friends[:SUGGESTION_FANOUT]:
+                    for candidate_id in self.friends(friend_id)[:SUGGESTION_FANOUT]:
+                        if candidate_id != user_id and not self.are_friends(
+                            user_id, candidate_id
+                        ):
+                            candidates[candidate_id] = (
+                                candidates.get(candidate_id, 0) + 1
+                            )
+                results.suggestions = sorted(
+                    candidates.items(), key=lambda item: (-item[1], item[0])
+                )[:CACHED_SUGGESTIONS_PER_USER]
+            return results.suggestions[:limit]
+
+
+friend_graph = FriendGraph()
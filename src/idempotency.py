@@ -0,0 +1,33 @@
+import threading
+from collections import OrderedDict
+
+from . import schemas
+
+# Recent (sender id, idempotency key) -> message entries kept in memory
+IDEMPOTENCY_CACHE_SIZE = 50_000
+# Length of messages.idempotency_key, longer keys are rejected
+MAX_IDEMPOTENCY_KEY_LENGTH = 64
+
+
+class IdempotencyCache:
+    def __init__(self, max_size: int = IDEMPOTENCY_CACHE_SIZE):
+        self.max_size = max_size
+        self.messages: OrderedDict[tuple[int, str], schemas.Message] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sender_id: int, idempotency_key: str) -> schemas.Message | None:
+        with self.lock:
+            message = self.messages.get((sender_id, idempotency_key))
+            if message is not None:
+                self.messages.move_to_end((sender_id, idempotency_key))
+            return message
+
+    def put(self, sender_id: int, idempotency_key: str, message: schemas.Message):
+        with self.lock:
+            self.messages[(sender_id, idempotency_key)] = message
+            self.messages.move_to_end((sender_id, idempotency_key))
+            if len(self.messages) > self.max_size:
+                self.messages.popitem(last=False)
+
+
+idempotency_cache = IdempotencyCache()
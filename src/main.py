@@ -1,4 +1,5 @@
 from datetime import datetime
+import json
 from pydantic import BaseModel
 from typing import Union
 import re
@@ -6,6 +7,7 @@ import re
 from fastapi import (
     Depends,
     FastAPI,
+    Header,
     HTTPException,
     status,
     Request,
@@ -18,6 +20,7 @@ from fastapi.security import (
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 
 from fief_client import (
@@ -32,8 +35,35 @@ from fief_client.integrations.fastapi import FiefAuth
 from sqlalchemy.orm import Session
 import uvicorn
 
-from . import crud, models, schemas
-from .database import SessionLocal, engine
+from . import crud, schemas
+from .connections import (
+    HEARTBEAT_INTERVAL,
+    HEARTBEAT_TIMEOUT,
+    connections,
+)
+from .database import (
+    ReadSessionLocal,
+    SessionLocal,
+    client_wrote_recently,
+    prewarm_pool,
+    read_your_writes_middleware,
+    replica_router,
+)
+from .fief_guard import GuardedFief
+from .friend_graph import friend_graph
+from .idempotency import MAX_IDEMPOTENCY_KEY_LENGTH, idempotency_cache
+from .message_frames import MessageFrames
+from .notifications import notifications
+from .presence import presence
+from .query_counter import query_counter_middleware
+from .rate_limit import (
+    authorization_key,
+    friendship_request_rate_limit,
+    send_message_rate_limit,
+)
+from .streaming import stream_models
+from .typing_events import typing_events
+from .warmup import warmup
 from .constants import (
     FIEF_BASE_URL,
     CLIENT_ID,
@@ -42,13 +72,12 @@ from .constants import (
     EMAIL_REGEX,
 )
 
-models.Base.metadata.create_all(bind=engine)
-
-
-fief = FiefAsync(
-    FIEF_BASE_URL,
-    CLIENT_ID,
-    CLIENT_SECRET,
+fief = GuardedFief(
+    FiefAsync(
+        FIEF_BASE_URL,
+        CLIENT_ID,
+        CLIENT_SECRET,
+    )
 )
 
 scheme = OAuth2AuthorizationCodeBearer(
@@ -57,7 +86,7 @@ scheme = OAuth2AuthorizationCodeBearer(
     scopes={"openid": "openid", "offline_access": "offline_access"},
 )
 
-auth = FiefAuth(fief, scheme)
+auth = FiefAuth(fief.client, scheme)
 
 app = FastAPI()
 
@@ -71,6 +100,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.middleware("http")(query_counter_middleware)
+app.middleware("http")(read_your_writes_middleware)
+
 email_regex = re.compile(EMAIL_REGEX)
 
 
@@ -83,43 +115,42 @@ class UserChatMessages(BaseModel):
     all_messages: list[schemas.Message] = []
 
 
-class SingleConnection(BaseModel):
-    user_id: int
-    websocket: WebSocket
+@warmup.step("database_pool")
+async def warm_database_pool():
+    await run_in_threadpool(prewarm_pool)
 
-    class Config:
-        arbitrary_types_allowed = True
 
+@warmup.step("fief_jwks")
+async def warm_fief_jwks():
+    await fief.prefetch_keys()
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[SingleConnection] = []
 
-    def append_connection(self, user_id: int, websocket: WebSocket):
-        self.active_connections.append(
-            SingleConnection(user_id=user_id, websocket=websocket)
-        )
+def rebuild_friend_graph():
+    db = SessionLocal()
+    try:
+        crud.load_friend_graph(db=db)
+    finally:
+        db.close()
 
-    async def connect(self, user_id: int, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(
-            SingleConnection(user_id=user_id, websocket=websocket)
-        )
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections = [
-            connection
-            for connection in self.active_connections
-            if connection.websocket != websocket
-        ]
+@warmup.step("friend_graph")
+async def warm_friend_graph():
+    await friend_graph.refresh(rebuild_friend_graph)
+
 
-    async def notify_user_of_message(self, sender_id: int, recipient_id: int):
-        for connection in self.active_connections:
-            if connection.user_id == recipient_id:
-                await connection.websocket.send_text(str(sender_id))
+@app.on_event("startup")
+async def start_background_tasks():
+    warmup.start()
+    connections.start_heartbeat()
+    notifications.start(connections)
+    presence.start()
+    friend_graph.start(rebuild_friend_graph)
+    replica_router.start()
 
 
-connections = ConnectionManager()
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await presence.stop()
 
 
 def get_db():
@@ -130,6 +161,17 @@ def get_db():
         db.close()
 
 
+# Read-only endpoints, routed to a replica when one is configured
+def get_read_db(request: Request):
+    db = ReadSessionLocal()
+    if client_wrote_recently(request):
+        db.info["primary"] = True
+    try:
+        yield db
+    finally:
+        db.close()
+
+
 # Endpoints ------------------------------------------------------------------
 
 
@@ -139,6 +181,28 @@ def ping():
     return {"response_text": str(time)}
 
 
+@app.get("/ready/", response_model=BasicResponse)
+def ready():
+    if not warmup.ready:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={
+                "response_text": "warming up: " + ", ".join(warmup.pending()),
+                "errors": warmup.errors,
+            },
+        )
+    return {"response_text": "ready"}
+
+
+@app.get("/metrics/")
+def get_metrics():
+    return {
+        "notifications": notifications.metrics(),
+        "fief": fief.metrics(),
+        "typing": typing_events.metrics(),
+    }
+
+
 @app.get("/user_login_and_get_data/", response_model=schemas.User)
 async def user_login_and_get_data(
     access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
@@ -151,7 +215,7 @@ async def user_login_and_get_data(
     if not db_user_in_db:
         username = userinfo["fields"]["username"]
         return crud.create_registered_user(db=db, email=email, username=username)
-    return db_user_in_db
+    return crud.get_users_with_messages(db=db, users=[db_user_in_db])[0]
 
 
 @app.post("/users/", response_model=schemas.User)
@@ -164,35 +228,51 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
 
 @app.get("/users/", response_model=list[schemas.User])
-def get_many_users(user_count_to_return: int = 1, db: Session = Depends(get_db)):
+def get_many_users(user_count_to_return: int = 1, db: Session = Depends(get_read_db)):
     user_count = crud.get_user_count(db=db)
     if user_count_to_return > user_count:
         user_count_to_return = user_count
 
     users = crud.get_many_users(db=db, how_many=user_count_to_return)
 
-    return users
+    return crud.get_users_with_messages(db=db, users=users)
 
 
 @app.get("/users/{user_id}", response_model=schemas.User)
-def get_user(user_id: int, db: Session = Depends(get_db)):
+def get_user(user_id: int, db: Session = Depends(get_read_db)):
     db_user = crud.get_user(db=db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    return db_user
+    return crud.get_users_with_messages(db=db, users=[db_user])[0]
 
 
 @app.get("/users/{user_id}/messages/", response_model=list[schemas.Message])
-def get_user_received_messages(user_id: int, db: Session = Depends(get_db)):
+def get_user_received_messages(user_id: int, db: Session = Depends(get_read_db)):
     db_user = crud.get_user(db=db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return crud.get_user_received_messages(db=db, user_id=user_id)
 
 
+@app.post("/users/presence/", response_model=dict[int, bool])
+async def get_users_presence(
+    user_ids: schemas.UserIds,
+    db: Session = Depends(get_read_db),
+    access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
+):
+    this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
+    # Same audience as the pushed presence updates
+    friend_ids = [
+        user_id
+        for user_id in user_ids.ids
+        if friend_graph.are_friends(this_user_id, user_id)
+    ]
+    return presence.lookup(db=db, user_ids=friend_ids)
+
+
 @app.get("/users/all/", response_model=list[schemas.UserDisplay])
-def get_all_users(db: Session = Depends(get_db)):
+def get_all_users(db: Session = Depends(get_read_db)):
     user_count = crud.get_user_count(db=db)
     users = crud.get_many_users(db=db, how_many=user_count)
 
@@ -268,38 +348,52 @@ async def create_message(
 
 
 @app.get("/users/me/", response_model=schemas.User)
-def read_users_me(
+async def read_users_me(
     access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
-    token_data = fief.userinfo(access_token_info.access_token)
-    user = crud.get_user_by_email(db=db, user_email=token_data.email)
-    return user
+    userinfo = await fief.userinfo(access_token_info["access_token"])
+    user = crud.get_user_by_email(db=db, user_email=userinfo["email"])
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return crud.get_users_with_messages(db=db, users=[user])[0]
 
 
 @app.get("/users/me/my_messages/received", response_model=list[schemas.Message])
-def read_users_me_messages_received(
+async def read_users_me_messages_received(
+    request: Request,
+    stream: bool = False,
     access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
-    token_data = fief.userinfo(access_token_info.access_token)
-    received_messages = crud.get_user_received_messages(
-        db=db,
-        user_id=crud.convert_user_email_to_user_id(db=db, user_email=token_data.email),
-    )
+    this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
+    if stream:
+        return stream_models(
+            request,
+            crud.iter_user_received_messages(db=db, user_id=this_user_id),
+            schemas.Message,
+        )
+
+    received_messages = crud.get_user_received_messages(db=db, user_id=this_user_id)
     return received_messages
 
 
 @app.get("/users/me/my_messages/sent", response_model=list[schemas.Message])
-def read_users_me_messages_sent(
+async def read_users_me_messages_sent(
+    request: Request,
+    stream: bool = False,
     access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
-    token_data = fief.userinfo(access_token_info.access_token)
-    sent_messages = crud.get_user_sent_messages(
-        db=db,
-        user_id=crud.convert_user_email_to_user_id(db=db, user_email=token_data.email),
-    )
+    this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
+    if stream:
+        return stream_models(
+            request,
+            crud.iter_user_sent_messages(db=db, user_id=this_user_id),
+            schemas.Message,
+        )
+
+    sent_messages = crud.get_user_sent_messages(db=db, user_id=this_user_id)
     return sent_messages
 
 
@@ -318,7 +412,10 @@ async def get_fief_user(
     return access_token_info
 
 
-@app.post("/user/friends/requests/send")
+@app.post(
+    "/user/friends/requests/send",
+    dependencies=[Depends(friendship_request_rate_limit)],
+)
 async def send_friendship_request(
     adressee_id: schemas.UserId,
     db: Session = Depends(get_db),
@@ -385,9 +482,63 @@ async def accept_friendship_request(
     raise HTTPException(status_code=404, detail="Friendship requester not found")
 
 
+@app.post("/user/friends/requests/accept/bulk/")
+async def accept_friendship_requests(
+    requester_ids: schemas.UserIds,
+    db: Session = Depends(get_db),
+    access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
+):
+    this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
+    friendship_statuses, invalid_ids = crud.accept_friendship_requests(
+        db=db, this_user=this_user_id, other_users=requester_ids.ids
+    )
+    if invalid_ids:
+        raise HTTPException(
+            status_code=404,
+            detail={"message": "Friendship request not found", "ids": invalid_ids},
+        )
+    return friendship_statuses
+
+
+@app.post("/user/friends/requests/deny/bulk/")
+async def deny_friendship_requests(
+    requester_ids: schemas.UserIds,
+    db: Session = Depends(get_db),
+    access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
+):
+    this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
+    friendship_statuses, invalid_ids = crud.deny_friendship_requests(
+        db=db, this_user=this_user_id, other_users=requester_ids.ids
+    )
+    if invalid_ids:
+        raise HTTPException(
+            status_code=404,
+            detail={"message": "Friendship request not found", "ids": invalid_ids},
+        )
+    return friendship_statuses
+
+
+@app.post("/user/friends/block/bulk/")
+async def block_friendships(
+    user_ids: schemas.UserIds,
+    db: Session = Depends(get_db),
+    access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
+):
+    this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
+    friendship_statuses, invalid_ids = crud.block_friendships(
+        db=db, this_user=this_user_id, other_users=user_ids.ids
+    )
+    if invalid_ids:
+        raise HTTPException(
+            status_code=404,
+            detail={"message": "Friendship not found", "ids": invalid_ids},
+        )
+    return friendship_statuses
+
+
 @app.get("/user/friends/", response_model=list[schemas.UserDisplay])
 async def get_user_friends(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
 ):
     this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
@@ -395,9 +546,48 @@ async def get_user_friends(
     return crud.get_user_friends(db=db, this_user=this_user_id)
 
 
+@app.get("/user/friends/suggestions/", response_model=list[schemas.FriendSuggestion])
+async def get_friend_suggestions(
+    how_many: int = 10,
+    db: Session = Depends(get_read_db),
+    access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
+):
+    this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
+    how_many = max(1, min(how_many, 50))
+
+    suggestions = crud.get_friend_suggestions(
+        db=db, this_user=this_user_id, how_many=how_many
+    )
+    return [
+        schemas.FriendSuggestion(
+            id=user.id,
+            is_online=user.is_online,
+            user_name=user.user_name,
+            mutual_friend_count=mutual_friend_count,
+        )
+        for user, mutual_friend_count in suggestions
+    ]
+
+
+@app.get("/user/friends/{friend_id}/mutual/", response_model=schemas.MutualFriends)
+async def get_mutual_friend_count(
+    friend_id: int,
+    db: Session = Depends(get_read_db),
+    access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
+):
+    this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
+
+    return {
+        "user_id": friend_id,
+        "mutual_friend_count": crud.get_mutual_friend_count(
+            db=db, this_user=this_user_id, other_user=friend_id
+        ),
+    }
+
+
 @app.get("/user/friends/requests/", response_model=list[schemas.UserDisplay])
 async def get_users_that_requested_friends_to_user(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
 ):
     this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
@@ -410,7 +600,10 @@ async def get_users_that_requested_friends_to_user(
 @app.get("/user/friends/{friend_id}/messages/", response_model=UserChatMessages)
 async def get_friend_messages(
     friend_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    stream: bool = False,
+    limit: Union[int, None] = None,
+    db: Session = Depends(get_read_db),
     access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
 ):
     this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
@@ -421,8 +614,26 @@ async def get_friend_messages(
     if friend not in user_friends:
         raise HTTPException(status_code=403, detail="Forbidden")
 
+    if stream and limit is not None:
+        # Streaming is for the full history, a limited one fits in a response
+        raise HTTPException(status_code=400, detail="limit can't be used with stream")
+
+    if stream:
+        return stream_models(
+            request,
+            crud.iter_friend_messages_sorted(
+                db=db, user_id=this_user_id, friend_id=friend_id
+            ),
+            schemas.Message,
+            prefix=f'{{"from_user_id": {friend_id}, "all_messages": ',
+            suffix="}",
+        )
+
+    if limit is not None and limit < 0:
+        raise HTTPException(status_code=400, detail="Bad request")
+
     all_messages = crud.get_friend_messages_sorted(
-        db=db, user_id=this_user_id, friend_id=friend_id
+        db=db, user_id=this_user_id, friend_id=friend_id, limit=limit
     )
     return {
         "from_user_id": friend_id,
@@ -436,7 +647,7 @@ async def get_friend_messages(
 )
 async def get_friend_last_message(
     friend_id: int,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
 ):
     this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
@@ -455,27 +666,54 @@ async def get_friend_last_message(
     return last_message
 
 
-@app.post("/user/friends/{friend_id}/messages/", response_model=schemas.Message)
+@app.post(
+    "/user/friends/{friend_id}/messages/",
+    response_model=schemas.Message,
+    dependencies=[Depends(send_message_rate_limit)],
+)
 async def send_message(
     message_text: schemas.SendMessageSchema,
     friend_id: int,
+    idempotency_key: Union[str, None] = Header(
+        default=None, max_length=MAX_IDEMPOTENCY_KEY_LENGTH
+    ),
     db: Session = Depends(get_db),
     access_token_info: FiefAccessTokenInfo = Depends(auth.authenticated()),
 ):
 
     this_user_id = await get_auth_user_id(db=db, access_token_info=access_token_info)
 
+    if idempotency_key is not None:
+        cached_message = idempotency_cache.get(this_user_id, idempotency_key)
+        if cached_message is not None:
+            return cached_message
+
     user_friends = crud.get_user_friends(db=db, this_user=this_user_id)
     friend = crud.get_user(db=db, user_id=friend_id)
 
     if friend not in user_friends:
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    message = crud.create_message(
-        db=db, message=message_text, sender_id=this_user_id, receiver_id=friend_id
-    )
+    if idempotency_key is None:
+        message = crud.create_message(
+            db=db, message=message_text, sender_id=this_user_id, receiver_id=friend_id
+        )
+        created = True
+    else:
+        message, created = crud.create_message_idempotent(
+            db=db,
+            message=message_text,
+            sender_id=this_user_id,
+            receiver_id=friend_id,
+            idempotency_key=idempotency_key,
+        )
+        idempotency_cache.put(
+            this_user_id, idempotency_key, schemas.Message.from_orm(message)
+        )
 
-    await connections.notify_user_of_message(this_user_id, friend_id)
+    if created:
+        typing_events.message_sent(this_user_id, friend_id)
+        notifications.notify_user_of_message(this_user_id, friend_id)
 
     return message
 
@@ -491,10 +729,10 @@ async def ws_new_chat_messages(
     email = str(websocket_auth["email"])
     access_token = str(websocket_auth["access_token"])
 
-    if re.fullmatch(email_regex, email) is False:
+    if re.fullmatch(email_regex, email) is None:
         print("WebSocket message is not a valid email")
-        websocket.close(reason="Invalid email")
-        raise ValueError("Invalid email error")
+        await websocket.close(reason="Invalid email")
+        return
 
     try:
         db_email = (
@@ -505,22 +743,76 @@ async def ws_new_chat_messages(
         if db_email != email:
             raise ValueError("Invalid email error")
     except FiefAccessTokenInvalid:
-        websocket.close(reason="Failed to authorize")
+        await websocket.close(reason="Failed to authorize")
+        return
     except FiefAccessTokenExpired:
-        websocket.close(reason="Access token expired")
+        await websocket.close(reason="Access token expired")
+        return
+    except HTTPException:
+        await websocket.close(code=1013, reason="Authorization unavailable")
+        return
 
     this_user_id = crud.convert_user_email_to_user_id(db, email)
     if this_user_id is None:
-        websocket.close(reason="Invalid email")
+        await websocket.close(reason="Invalid email")
         raise ValueError("DB error")
 
-    connections.append_connection(this_user_id, websocket)
+    # Don't hold a pooled connection for the lifetime of the socket
+    db.close()
+
+    # Same rate limit buckets as the HTTP endpoints
+    rate_limit_ip = websocket.client.host if websocket.client is not None else None
+    rate_limit_user_key = authorization_key(f"Bearer {access_token}")
+
+    # "heartbeat": true in the auth frame asks for app-level "ping" frames
+    connection = connections.append_connection(
+        this_user_id, websocket, heartbeat=websocket_auth.get("heartbeat") is True
+    )
+    if connection is None:
+        await websocket.close(code=1013, reason="Too many connections")
+        return
 
+    message_frames = MessageFrames(
+        connection, this_user_id, (rate_limit_ip, rate_limit_user_key)
+    )
+    message_frames.start()
     try:
         while True:
-            await websocket.receive_text()
+            frame = parse_ws_frame(await websocket.receive_text())
+            if frame is None:
+                continue
+
+            if frame.get("type") == "message":
+                message_frames.put(frame)
+            elif frame.get("type") in ("typing", "stop_typing"):
+                ws_typing(this_user_id, frame)
     except WebSocketDisconnect:
-        connections.disconnect(websocket)
+        pass
+    finally:
+        connections.disconnect(connection)
+        await message_frames.close()
+
+
+def parse_ws_frame(text: str) -> dict | None:
+    # Plain text frames (e.g. "pong" answers to pings) are ignored
+    try:
+        frame = json.loads(text)
+    except ValueError:
+        return None
+    return frame if isinstance(frame, dict) else None
+
+
+def ws_typing(this_user_id: int, frame: dict):
+    # Ephemeral, malformed or unauthorized frames are dropped without a reply.
+    # Typing frames are too frequent for a DB check each, a friendship change
+    # reaches the friend graph within GRAPH_MAX_AGE at worst.
+    try:
+        friend_id = int(frame["friend_id"])
+    except (KeyError, TypeError, ValueError):
+        return
+    if not friend_graph.are_friends(this_user_id, friend_id):
+        return
+    typing_events.publish(this_user_id, friend_id, frame["type"] == "typing")
 
 
 # DEV ONLY!!!
@@ -547,8 +839,17 @@ async def send_message(
 # returns user_id of current user
 async def get_auth_user_id(db: Session, access_token_info: FiefAccessTokenInfo):
     userinfo = await fief.userinfo(access_token_info["access_token"])
-    return crud.convert_user_email_to_user_id(db=db, user_email=userinfo["email"])
+    user_id = crud.convert_user_email_to_user_id(db=db, user_email=userinfo["email"])
+    # Lets a read session keep this user on the primary right after a write
+    db.info["user_id"] = user_id
+    return user_id
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=7000)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=7000,
+        ws_ping_interval=HEARTBEAT_INTERVAL,
+        ws_ping_timeout=HEARTBEAT_TIMEOUT,
+    )
@@ -0,0 +1,96 @@
+import asyncio
+
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, schemas
+from .database import SessionLocal
+
+# Seconds to wait for more messages before writing a batch
+MESSAGE_BATCH_WINDOW = 0.005
+MESSAGE_BATCH_SIZE = 200
+
+
+class PendingMessage:
+    __slots__ = ("row", "future")
+
+    def __init__(self, row: dict, future: asyncio.Future):
+        self.row = row
+        self.future = future
+
+
+class MessageBatcher:
+    # Collects messages sent close together (e.g. pipelined over a websocket)
+    # and writes them with one multi-row insert
+    def __init__(self):
+        self.pending: list[PendingMessage] = []
+        self.flush_task: asyncio.Task | None = None
+        self.write_tasks: set[asyncio.Task] = set()
+        # Batches are written one at a time, in the order they were taken
+        self.write_lock = asyncio.Lock()
+
+    def submit(
+        self,
+        sender_id: int,
+        receiver_id: int,
+        content: str,
+        idempotency_key: str | None = None,
+    ) -> asyncio.Future:
+        # Queues the message without waiting for its insert, messages are
+        # written in the order they are submitted. The future resolves to
+        # (message, created) like crud.create_message_idempotent.
+        future = asyncio.get_running_loop().create_future()
+        row = {
+            "content": content,
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "idempotency_key": idempotency_key,
+        }
+        self.pending.append(PendingMessage(row, future))
+        if len(self.pending) >= MESSAGE_BATCH_SIZE:
+            batch, self.pending = self.pending, []
+            task = asyncio.create_task(self.write(batch))
+            self.write_tasks.add(task)
+            task.add_done_callback(self.write_tasks.discard)
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+        return future
+
+    async def flush_later(self):
+        await asyncio.sleep(MESSAGE_BATCH_WINDOW)
+        self.flush_task = None
+        await self.flush()
+
+    def write_batch(self, rows: list[dict]):
+        db = SessionLocal()
+        try:
+            return crud.create_messages(db=db, messages=rows)
+        finally:
+            db.close()
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        await self.write(batch)
+
+    async def write(self, batch: list[PendingMessage]):
+        if not batch:
+            return
+
+        try:
+            async with self.write_lock:
+                db_messages = await run_in_threadpool(
+                    self.write_batch, [pending.row for pending in batch]
+                )
+        except Exception as error:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(error)
+            return
+
+        for pending, (db_message, created) in zip(batch, db_messages):
+            if not pending.future.done():
+                pending.future.set_result(
+                    (schemas.Message.parse_obj(db_message), created)
+                )
+
+
+message_batcher = MessageBatcher()
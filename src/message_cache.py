@@ -0,0 +1,204 @@
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+from . import schemas
+
+# Most recent messages kept per conversation
+CONVERSATION_CACHE_SIZE = 50
+# Approximate bytes of cached messages across all conversations, least
+# recently used conversations are evicted past it
+MESSAGE_CACHE_BUDGET = 64 * 1024 * 1024
+# Seconds a conversation is served from memory before it is reloaded
+MESSAGE_CACHE_TTL = 30
+# Rough per-message cost on top of the content itself
+MESSAGE_OVERHEAD = 160
+# Conversations whose latest write sequence is remembered, see fill()
+TRACKED_WRITES = 10_000
+
+# (id, sender_id, receiver_id, created_datetime, content)
+CachedMessage = tuple
+
+
+class ConversationCache:
+    __slots__ = ("messages", "complete", "size", "loaded_at")
+
+    def __init__(self, complete: bool):
+        self.messages: deque[CachedMessage] = deque(maxlen=CONVERSATION_CACHE_SIZE)
+        # True when the deque holds the whole conversation
+        self.complete = complete
+        self.size = 0
+        self.loaded_at = time.monotonic()
+
+
+def message_size(message: CachedMessage) -> int:
+    return MESSAGE_OVERHEAD + sys.getsizeof(message[4])
+
+
+def to_schema(message: CachedMessage) -> schemas.Message:
+    id, sender_id, receiver_id, created_datetime, content = message
+    return schemas.Message(
+        id=id,
+        sender_id=sender_id,
+        receiver_id=receiver_id,
+        created_datetime=created_datetime,
+        content=content,
+    )
+
+
+def conversation_key(user_id: int, friend_id: int) -> tuple[int, int]:
+    return (user_id, friend_id) if user_id < friend_id else (friend_id, user_id)
+
+
+class MessageCache:
+    def __init__(self, budget: int = MESSAGE_CACHE_BUDGET):
+        self.budget = budget
+        self.conversations: OrderedDict[tuple[int, int], ConversationCache] = (
+            OrderedDict()
+        )
+        self.total_size = 0
+        self.lock = threading.Lock()
+        # Bumped on every write, conversation key -> sequence of its last write
+        self.sequence = 0
+        self.recent_writes: OrderedDict[tuple[int, int], int] = OrderedDict()
+
+    def snapshot(self) -> int:
+        # Take before reading from the DB and pass to fill()
+        return self.sequence
+
+    def warm_conversation(self, user_id: int, friend_id: int):
+        key = conversation_key(user_id, friend_id)
+        conversation = self.conversations.get(key)
+        if conversation is None:
+            return None
+        if time.monotonic() - conversation.loaded_at > MESSAGE_CACHE_TTL:
+            self.remove(key)
+            return None
+        self.conversations.move_to_end(key)
+        return conversation
+
+    def validated_conversation(
+        self, user_id: int, friend_id: int, newest_id: int | None
+    ):
+        # newest_id is the id of the conversation's newest message in the DB,
+        # a newer one than cached was written by another worker. Call with the
+        # lock held.
+        conversation = self.warm_conversation(user_id, friend_id)
+        if conversation is None:
+            return None
+        cached_newest_id = (
+            conversation.messages[-1][0] if conversation.messages else None
+        )
+        if newest_id is not None and (
+            cached_newest_id is None or newest_id > cached_newest_id
+        ):
+            self.remove(conversation_key(user_id, friend_id))
+            return None
+        return conversation
+
+    def get_recent(
+        self, user_id: int, friend_id: int, limit: int, newest_id: int | None
+    ):
+        # Oldest first like get_friend_messages_sorted, None when not warm
+        with self.lock:
+            conversation = self.validated_conversation(user_id, friend_id, newest_id)
+            if conversation is None:
+                return None
+            if limit > len(conversation.messages) and not conversation.complete:
+                return None
+            messages = list(conversation.messages)[-limit:] if limit else []
+        return [to_schema(message) for message in messages]
+
+    def get_last_message_from(
+        self, sender_id: int, receiver_id: int, newest_id: int | None
+    ):
+        # Returns (found, message), found is False when the DB has to be asked
+        with self.lock:
+            conversation = self.validated_conversation(
+                sender_id, receiver_id, newest_id
+            )
+            if conversation is None:
+                return False, None
+            for message in reversed(conversation.messages):
+                if message[1] == sender_id:
+                    return True, to_schema(message)
+            return conversation.complete, None
+
+    def fill(
+        self,
+        user_id: int,
+        friend_id: int,
+        messages: list,
+        complete: bool,
+        snapshot: int,
+    ):
+        # messages are the conversation's most recent ones, oldest first. The
+        # fill is skipped if the conversation was written to since snapshot,
+        # the DB read may have missed that message.
+        key = conversation_key(user_id, friend_id)
+        conversation = ConversationCache(complete)
+        for message in messages[-CONVERSATION_CACHE_SIZE:]:
+            cached_message = (
+                message.id,
+                message.sender_id,
+                message.receiver_id,
+                message.created_datetime,
+                message.content,
+            )
+            conversation.messages.append(cached_message)
+            conversation.size += message_size(cached_message)
+
+        with self.lock:
+            if self.recent_writes.get(key, 0) > snapshot:
+                return
+            self.remove(key)
+            self.conversations[key] = conversation
+            self.total_size += conversation.size
+            self.evict()
+
+    def append(self, message: dict):
+        # Write-through from crud, only conversations already in memory are
+        # kept up to date
+        key = conversation_key(message["sender_id"], message["receiver_id"])
+        cached_message = (
+            message["id"],
+            message["sender_id"],
+            message["receiver_id"],
+            message["created_datetime"],
+            message["content"],
+        )
+        with self.lock:
+            self.sequence += 1
+            self.recent_writes[key] = self.sequence
+            self.recent_writes.move_to_end(key)
+            if len(self.recent_writes) > TRACKED_WRITES:
+                self.recent_writes.popitem(last=False)
+
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                return
+
+            if len(conversation.messages) == conversation.messages.maxlen:
+                dropped = conversation.messages.popleft()
+                conversation.size -= message_size(dropped)
+                self.total_size -= message_size(dropped)
+                conversation.complete = False
+            conversation.messages.append(cached_message)
+            conversation.size += message_size(cached_message)
+            self.total_size += message_size(cached_message)
+            self.conversations.move_to_end(key)
+            self.evict()
+
+    def remove(self, key: tuple[int, int]):
+        conversation = self.conversations.pop(key, None)
+        if conversation is not None:
+            self.total_size -= conversation.size
+
+    def evict(self):
+        while self.total_size > self.budget and self.conversations:
+            _, conversation = self.conversations.popitem(last=False)
+            self.total_size -= conversation.size
+
+
+message_cache = MessageCache()
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, schemas
+from .connections import SingleConnection
+from .database import SessionLocal
+from .idempotency import MAX_IDEMPOTENCY_KEY_LENGTH, idempotency_cache
+from .message_batcher import message_batcher
+from .notifications import notifications
+from .rate_limit import send_message_rate_limit
+from .typing_events import typing_events
+
+logger = logging.getLogger(__name__)
+
+
+def ack_frame(client_id, message: schemas.Message) -> dict:
+    return {
+        "type": "ack",
+        "client_id": client_id,
+        "id": message.id,
+        "message": jsonable_encoder(message),
+    }
+
+
+def error_frame(client_id, detail: str) -> dict:
+    return {"type": "error", "client_id": client_id, "detail": detail}
+
+
+def are_friends(this_user_id: int, friend_id: int) -> bool:
+    # Checked against the primary like the HTTP send, not the friend graph
+    # which can lag behind friendship changes made on other workers
+    db = SessionLocal()
+    try:
+        return crud.are_friends(db=db, this_user=this_user_id, other_user=friend_id)
+    finally:
+        db.close()
+
+
+class PendingSend:
+    __slots__ = ("client_id", "idempotency_key", "friend_id", "future")
+
+    def __init__(
+        self,
+        client_id,
+        idempotency_key: str | None,
+        friend_id: int,
+        future: asyncio.Future,
+    ):
+        self.client_id = client_id
+        self.idempotency_key = idempotency_key
+        self.friend_id = friend_id
+        self.future = future
+
+
+class MessageFrames:
+    # "message" frames of one websocket. They keep their arrival order through
+    # two stages: checks run one frame at a time and queue the message in the
+    # batcher without waiting for its insert, so pipelined frames still share
+    # a batch. Replies are sent in the same order once the inserts are done.
+    def __init__(
+        self,
+        connection: SingleConnection,
+        user_id: int,
+        rate_limit_keys: tuple[str | None, str | None],
+    ):
+        self.connection = connection
+        self.user_id = user_id
+        self.rate_limit_keys = rate_limit_keys
+        self.frames: asyncio.Queue[dict | None] = asyncio.Queue()
+        self.replies: asyncio.Queue[dict | PendingSend | None] = asyncio.Queue()
+        self.worker_tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self.worker_tasks = [
+            asyncio.create_task(self.check_frames()),
+            asyncio.create_task(self.send_replies()),
+        ]
+
+    def put(self, frame: dict):
+        self.frames.put_nowait(frame)
+
+    async def close(self):
+        # Frames already received are still sent
+        self.frames.put_nowait(None)
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+
+    async def check_frames(self):
+        while (frame := await self.frames.get()) is not None:
+            self.replies.put_nowait(await self.check(frame))
+        self.replies.put_nowait(None)
+
+    async def check(self, frame: dict) -> dict | PendingSend:
+        # Returns the reply frame, or the message queued in the batcher
+        client_id = frame.get("client_id")
+        # The client generated id doubles as the idempotency key for retries
+        idempotency_key = str(client_id) if client_id is not None else None
+
+        if (
+            idempotency_key is not None
+            and len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH
+        ):
+            # Truncating could make two different ids share a key
+            return error_frame(client_id, "client_id is too long")
+
+        try:
+            friend_id = int(frame["friend_id"])
+            message_text = schemas.SendMessageSchema(content=frame["content"])
+        except (KeyError, TypeError, ValueError):
+            return error_frame(client_id, "Bad request")
+
+        if idempotency_key is not None:
+            cached_message = idempotency_cache.get(self.user_id, idempotency_key)
+            if cached_message is not None:
+                return ack_frame(client_id, cached_message)
+
+        rate_limit_ip, rate_limit_user_key = self.rate_limit_keys
+        if await send_message_rate_limit.take(
+            ip=rate_limit_ip, user_key=rate_limit_user_key
+        ):
+            return error_frame(client_id, "Too many requests")
+
+        if not await run_in_threadpool(are_friends, self.user_id, friend_id):
+            return error_frame(client_id, "Forbidden")
+
+        future = message_batcher.submit(
+            sender_id=self.user_id,
+            receiver_id=friend_id,
+            content=message_text.content,
+            idempotency_key=idempotency_key,
+        )
+        return PendingSend(client_id, idempotency_key, friend_id, future)
+
+    async def reply(self, reply_frame: dict):
+        try:
+            await self.connection.websocket.send_text(json.dumps(reply_frame))
+        except Exception:
+            pass
+
+    async def send_replies(self):
+        while (pending := await self.replies.get()) is not None:
+            if isinstance(pending, dict):
+                await self.reply(pending)
+                continue
+
+            try:
+                message, created = await pending.future
+            except Exception:
+                logger.exception("Websocket message not sent")
+                await self.reply(error_frame(pending.client_id, "Not sent"))
+                continue
+            await self.reply(ack_frame(pending.client_id, message))
+            if pending.idempotency_key is not None:
+                idempotency_cache.put(self.user_id, pending.idempotency_key, message)
+            if created:
+                typing_events.message_sent(self.user_id, pending.friend_id)
+                notifications.notify_user_of_message(self.user_id, pending.friend_id)
@@ -0,0 +1,212 @@
+# Versioned schema migrations, run once per deploy before the workers start:
+#
+#     python -m src.migrations
+#
+# Every migration is idempotent so databases created by the old
+# create_all-at-import behaviour can be brought under version control.
+
+from typing import Callable
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from . import models
+from .database import engine
+from .sharding import shards
+
+# Arbitrary key for pg_advisory_lock so concurrent runs wait for each other
+MIGRATION_LOCK_ID = 7_215_001
+
+version_metadata = MetaData()
+schema_version = Table(
+    "schema_version", version_metadata, Column("version", Integer, nullable=False)
+)
+
+
+# Frozen copy of the messages columns indexed by later migrations. Those
+# indexes are kept off models.Message because migration 2 creates every index
+# of the model, and runs before the idempotency_key column exists.
+message_columns = Table(
+    "messages",
+    MetaData(),
+    Column("id", Integer),
+    Column("sender_id", Integer),
+    Column("receiver_id", Integer),
+    Column("created_datetime", DateTime),
+    Column("idempotency_key", String(64)),
+)
+message_idempotency_index = Index(
+    "uq_messages_sender_idempotency_key",
+    message_columns.c.sender_id,
+    message_columns.c.idempotency_key,
+    unique=True,
+)
+# Same expressions as models.conversation_low/conversation_high. Expression
+# indexes are not reflected, so it is created with IF NOT EXISTS rather than
+# checkfirst.
+conversation_pair_index = Index(
+    "ix_messages_conversation_pair",
+    models.least(message_columns.c.sender_id, message_columns.c.receiver_id),
+    models.greatest(message_columns.c.sender_id, message_columns.c.receiver_id),
+    message_columns.c.created_datetime,
+    message_columns.c.id,
+)
+# The newest message from one user to another, ties on created_datetime are
+# broken by id like in the conversation queries
+conversation_direction_index = Index(
+    "ix_messages_conversation_direction",
+    message_columns.c.sender_id,
+    message_columns.c.receiver_id,
+    message_columns.c.created_datetime,
+    message_columns.c.id,
+)
+
+
+def create_base_schema(connection: Connection):
+    models.Base.metadata.create_all(bind=connection)
+
+
+def add_hot_query_indexes(connection: Connection):
+    for index in (
+        *models.Message.__table__.indexes,
+        *models.Friendship.__table__.indexes,
+    ):
+        index.create(bind=connection, checkfirst=True)
+
+
+def add_message_idempotency_key(connection: Connection):
+    columns = inspect(connection).get_columns(models.Message.__tablename__)
+    if "idempotency_key" not in {column["name"] for column in columns}:
+        connection.execute(
+            text("ALTER TABLE messages ADD COLUMN idempotency_key VARCHAR(64)")
+        )
+    message_idempotency_index.create(bind=connection, checkfirst=True)
+
+
+def add_user_presence(connection: Connection):
+    models.UserPresence.__table__.create(bind=connection, checkfirst=True)
+    # is_online is derived from user_presence from now on, no rows yet means
+    # nobody is online
+    connection.execute(text("UPDATE users SET is_online = false"))
+
+
+def add_conversation_pair_index(connection: Connection):
+    connection.execute(CreateIndex(conversation_pair_index, if_not_exists=True))
+
+
+def add_conversation_direction_index(connection: Connection):
+    # IF NOT EXISTS, checkfirst would reflect the expression index above
+    connection.execute(CreateIndex(conversation_direction_index, if_not_exists=True))
+
+
+MIGRATIONS: list[tuple[int, Callable[[Connection], None]]] = [
+    (1, create_base_schema),
+    (2, add_hot_query_indexes),
+    (3, add_message_idempotency_key),
+    (4, add_user_presence),
+    (5, add_conversation_pair_index),
+    (6, add_conversation_direction_index),
+]
+
+
+# Message shards only hold the messages table, without the foreign keys to
+# users which live in the main database
+def create_shard_messages_table(connection: Connection, shard_index: int):
+    table = models.Message.__table__
+    if not inspect(connection).has_table(table.name):
+        connection.execute(CreateTable(table, include_foreign_key_constraints=[]))
+        for index in (*table.indexes, message_idempotency_index):
+            connection.execute(CreateIndex(index))
+
+    if connection.dialect.name == "postgresql":
+        # Interleave ids so they stay unique across shards, past the ids of
+        # a table that already held messages
+        shard_count = len(shards.engines)
+        max_id = connection.execute(select(func.max(table.c.id))).scalar() or 0
+        restart = max_id - max_id % shard_count + shard_index + 1
+        if restart <= max_id:
+            restart += shard_count
+        connection.execute(
+            text(
+                f"ALTER SEQUENCE messages_id_seq INCREMENT BY {shard_count} "
+                f"RESTART WITH {restart}"
+            )
+        )
+
+
+def add_shard_conversation_pair_index(connection: Connection, shard_index: int):
+    add_conversation_pair_index(connection)
+
+
+def add_shard_conversation_direction_index(connection: Connection, shard_index: int):
+    add_conversation_direction_index(connection)
+
+
+SHARD_MIGRATIONS: list[tuple[int, Callable[[Connection, int], None]]] = [
+    (1, create_shard_messages_table),
+    (2, add_shard_conversation_pair_index),
+    (3, add_shard_conversation_direction_index),
+]
+
+
+def get_schema_version(connection: Connection) -> int:
+    version_metadata.create_all(bind=connection)
+    return connection.execute(select(schema_version.c.version)).scalar() or 0
+
+
+def run_migrations(
+    engine: Engine = engine,
+    migrations: list[tuple[int, Callable]] = MIGRATIONS,
+    shard_index: int | None = None,
+) -> int:
+    # shard_index is passed on to the migrations of a message shard
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(
+                text("SELECT pg_advisory_xact_lock(:lock_id)"),
+                {"lock_id": MIGRATION_LOCK_ID},
+            )
+
+        current_version = get_schema_version(connection)
+        for version, migrate in migrations:
+            if version <= current_version:
+                continue
+            print(f"Applying migration {version}: {migrate.__name__}")
+            if shard_index is None:
+                migrate(connection)
+            else:
+                migrate(connection, shard_index)
+            current_version = version
+
+        connection.execute(schema_version.delete())
+        connection.execute(schema_version.insert().values(version=current_version))
+
+    return current_version
+
+
+def run_shard_migrations() -> list[int]:
+    return [
+        run_migrations(
+            engine=shard_engine, migrations=SHARD_MIGRATIONS, shard_index=shard_index
+        )
+        for shard_index, shard_engine in enumerate(shards.engines)
+    ]
+
+
+if __name__ == "__main__":
+    print(f"Schema at version {run_migrations()}")
+    for shard_index, version in enumerate(run_shard_migrations()):
+        print(f"Message shard {shard_index} at version {version}")
@@ -3,6 +3,7 @@ from sqlalchemy import (
     Column,
     ForeignKey,
     ForeignKeyConstraint,
+    Index,
     Integer,
     String,
     DateTime,
@@ -24,6 +25,39 @@ def pg_utcnow(element, compiler, **kw):
     return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
 
 
+# SQLite (local message shards) already stores CURRENT_TIMESTAMP in UTC
+@compiles(utcnow)
+def default_utcnow(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+class least(expression.FunctionElement):
+    type = Integer()
+    inherit_cache = True
+
+
+class greatest(expression.FunctionElement):
+    type = Integer()
+    inherit_cache = True
+
+
+@compiles(least)
+@compiles(greatest)
+def default_least_greatest(element, compiler, **kw):
+    return f"{type(element).__name__}({compiler.process(element.clauses, **kw)})"
+
+
+# SQLite's multi-argument min() and max() are least() and greatest()
+@compiles(least, "sqlite")
+def sqlite_least(element, compiler, **kw):
+    return f"min({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(greatest, "sqlite")
+def sqlite_greatest(element, compiler, **kw):
+    return f"max({compiler.process(element.clauses, **kw)})"
+
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, index=True)
@@ -31,6 +65,9 @@ class Message(Base):
     sender_id = Column(Integer, ForeignKey("users.id"))
     receiver_id = Column(Integer, ForeignKey("users.id"))
     created_datetime = Column(DateTime, server_default=utcnow())
+    # Client supplied, lets retried sends resolve to the original message.
+    # Unique per sender, the index is created by migration 3 in migrations.py.
+    idempotency_key = Column(String(64), nullable=True)
 
     sender = relationship(
         "User", back_populates="sent_messages", foreign_keys=[sender_id]
@@ -39,13 +76,25 @@ class Message(Base):
         "User", back_populates="received_messages", foreign_keys=[receiver_id]
     )
 
+    __table_args__ = (
+        Index("ix_messages_conversation", sender_id, receiver_id, created_datetime),
+    )
+
+
+# Lower and higher user id of a message's conversation, the same for both
+# directions. Conversation queries filter on these exact expressions so a
+# single walk of ix_messages_conversation_pair (created by migration 5 in
+# migrations.py) returns the conversation in (created_datetime, id) order.
+conversation_low = least(Message.sender_id, Message.receiver_id)
+conversation_high = greatest(Message.sender_id, Message.receiver_id)
+
 
 class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True, index=True)
     user_email = Column(String(254), unique=True, index=True)
-    is_online = Column(Boolean, default=True)
+    is_online = Column(Boolean, default=False)
     user_name = Column(String(64))
 
     sent_messages = relationship(
@@ -56,11 +105,23 @@ class User(Base):
     )
 
 
+class UserPresence(Base):
+    # One row per user and worker holding sockets of that user, refreshed by
+    # the worker's presence flush. Rows of workers that stopped flushing expire.
+    __tablename__ = "user_presence"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    worker_id = Column(String(64), primary_key=True, index=True)
+    seen_at = Column(DateTime, nullable=False, index=True)
+
+
 class Friendship(Base):
     __tablename__ = "friendships"
 
     requester_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
-    adressee_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    adressee_id = Column(
+        Integer, ForeignKey("users.id"), primary_key=True, index=True
+    )
 
     created_datetime = Column(DateTime, server_default=utcnow())
 
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+# Notifications waiting to be pushed to websockets, split evenly over the lanes
+NOTIFICATION_QUEUE_SIZE = 10_000
+# Ephemeral notifications (typing indicators) waiting, split the same way.
+# They have their own queue so they never push out a message notification.
+EPHEMERAL_QUEUE_SIZE = 2_000
+# Each lane has a single worker and every recipient maps to one lane, so a
+# recipient's notifications go out in order and one at a time. A slow socket
+# holds up its lane for up to NOTIFICATION_SEND_TIMEOUT.
+NOTIFICATION_LANES = 16
+# Seconds a single socket send may take before the socket counts as too slow
+# and is dropped
+NOTIFICATION_SEND_TIMEOUT = 2
+# What to do when a lane is full: "drop_oldest" evicts the oldest queued
+# notification, "drop_newest" discards the one being added. A full ephemeral
+# queue always drops its oldest.
+NOTIFICATION_OVERFLOW_POLICY = "drop_oldest"
+
+logger = logging.getLogger(__name__)
+
+
+class Notification:
+    __slots__ = ("recipient_id", "text", "enqueued_at")
+
+    def __init__(self, recipient_id: int, text: str):
+        self.recipient_id = recipient_id
+        self.text = text
+        self.enqueued_at = time.monotonic()
+
+
+class NotificationLane:
+    def __init__(self, max_size: int, max_ephemeral: int):
+        self.max_size = max_size
+        self.queue: deque[Notification] = deque()
+        self.ephemeral: deque[Notification] = deque(maxlen=max_ephemeral)
+        self.ready = asyncio.Event()
+
+    def oldest(self) -> Notification | None:
+        # Both queues are in enqueue order, the older head goes first so a
+        # recipient sees everything in the order it happened
+        if not self.ephemeral:
+            return self.queue[0] if self.queue else None
+        if self.queue and self.queue[0].enqueued_at <= self.ephemeral[0].enqueued_at:
+            return self.queue[0]
+        return self.ephemeral[0]
+
+    def pop(self) -> Notification | None:
+        notification = self.oldest()
+        if notification is None:
+            self.ready.clear()
+        elif self.ephemeral and notification is self.ephemeral[0]:
+            self.ephemeral.popleft()
+        else:
+            self.queue.popleft()
+        return notification
+
+
+class NotificationDispatcher:
+    def __init__(
+        self,
+        max_size: int = NOTIFICATION_QUEUE_SIZE,
+        lanes: int = NOTIFICATION_LANES,
+        max_ephemeral: int = EPHEMERAL_QUEUE_SIZE,
+    ):
+        self.lanes = [
+            NotificationLane(max(1, max_size // lanes), max(1, max_ephemeral // lanes))
+            for _ in range(lanes)
+        ]
+        self.worker_tasks: list[asyncio.Task | None] = [None] * lanes
+        self.dispatched = 0
+        self.dropped = 0
+        self.ephemeral_dropped = 0
+        self.slow_connections_dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def lane(self, recipient_id: int) -> NotificationLane:
+        return self.lanes[recipient_id % len(self.lanes)]
+
+    def enqueue(self, recipient_id: int, text: str, ephemeral: bool = False) -> bool:
+        notification = Notification(recipient_id, text)
+        lane = self.lane(recipient_id)
+        if ephemeral:
+            if len(lane.ephemeral) == lane.ephemeral.maxlen:
+                self.ephemeral_dropped += 1
+            lane.ephemeral.append(notification)
+        else:
+            if len(lane.queue) >= lane.max_size:
+                self.dropped += 1
+                if NOTIFICATION_OVERFLOW_POLICY == "drop_newest":
+                    return False
+                lane.queue.popleft()
+            lane.queue.append(notification)
+        lane.ready.set()
+        return True
+
+    def notify_user_of_message(self, sender_id: int, recipient_id: int) -> bool:
+        return self.enqueue(recipient_id, str(sender_id))
+
+    async def deliver(self, connections, notification: Notification):
+        for connection in list(connections.user_connections(notification.recipient_id)):
+            try:
+                await asyncio.wait_for(
+                    connection.websocket.send_text(notification.text),
+                    NOTIFICATION_SEND_TIMEOUT,
+                )
+            except Exception:
+                self.slow_connections_dropped += 1
+                await connections.reap(connection)
+
+    async def worker(self, connections, lane: NotificationLane):
+        while True:
+            await lane.ready.wait()
+            notification = lane.pop()
+            if notification is None:
+                continue
+            try:
+                self.last_lag = time.monotonic() - notification.enqueued_at
+                self.max_lag = max(self.max_lag, self.last_lag)
+                await self.deliver(connections, notification)
+                self.dispatched += 1
+            except Exception:
+                logger.exception("Notification dispatch failed")
+
+    def start(self, connections):
+        for index, lane in enumerate(self.lanes):
+            task = self.worker_tasks[index]
+            if task is None or task.done():
+                self.worker_tasks[index] = asyncio.create_task(
+                    self.worker(connections, lane)
+                )
+
+    def metrics(self) -> dict:
+        oldest = [lane.oldest() for lane in self.lanes]
+        oldest_enqueued_at = min(
+            (
+                notification.enqueued_at
+                for notification in oldest
+                if notification is not None
+            ),
+            default=None,
+        )
+        oldest_lag = 0.0
+        if oldest_enqueued_at is not None:
+            oldest_lag = time.monotonic() - oldest_enqueued_at
+        return {
+            "queue_depth": sum(len(lane.queue) for lane in self.lanes),
+            "queue_capacity": sum(lane.max_size for lane in self.lanes),
+            "ephemeral_depth": sum(len(lane.ephemeral) for lane in self.lanes),
+            "dispatched": self.dispatched,
+            "dropped": self.dropped,
+            "ephemeral_dropped": self.ephemeral_dropped,
+            "slow_connections_dropped": self.slow_connections_dropped,
+            "oldest_queued_seconds": oldest_lag,
+            "last_lag_seconds": self.last_lag,
+            "max_lag_seconds": self.max_lag,
+        }
+
+
+notifications = NotificationDispatcher()
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+from starlette.concurrency import run_in_threadpool
+
+from . import crud
+from .database import SessionLocal
+from .friend_graph import friend_graph
+from .notifications import notifications
+
+# Seconds between coalesced presence writes and friend notifications
+PRESENCE_FLUSH_INTERVAL = 5
+# Seconds without a flush after which a worker's users no longer count as
+# online through it, covers workers that died without marking them offline
+PRESENCE_EXPIRY = 6 * PRESENCE_FLUSH_INTERVAL
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"[-64:]
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTracker:
+    def __init__(self, worker_id: str = WORKER_ID):
+        self.worker_id = worker_id
+        # Users with at least one live socket on this worker
+        self.online: set[int] = set()
+        # user id -> latest state not yet written/pushed
+        self.pending: dict[int, bool] = {}
+        self.flush_task: asyncio.Task | None = None
+
+    def mark_online(self, user_id: int):
+        self.online.add(user_id)
+        self.pending[user_id] = True
+
+    def mark_offline(self, user_id: int):
+        self.online.discard(user_id)
+        self.pending[user_id] = False
+
+    def lookup(self, db, user_ids: list[int]) -> dict[int, bool]:
+        presence = {user_id: True for user_id in user_ids if user_id in self.online}
+        others = [user_id for user_id in user_ids if user_id not in presence]
+        # Users connected to other workers, as of their last flush
+        presence.update(crud.get_users_online(db=db, user_ids=others))
+        return presence
+
+    def write_changes(self, changes: dict[int, bool]) -> dict[int, bool]:
+        # Returns the presence of the changed users across all workers, a user
+        # leaving this worker may still be connected to another one
+        now = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            return crud.update_presence(
+                db=db,
+                worker_id=self.worker_id,
+                online_ids=[user_id for user_id, online in changes.items() if online],
+                offline_ids=[
+                    user_id for user_id, online in changes.items() if not online
+                ],
+                seen_at=now,
+                expired_before=now - timedelta(seconds=PRESENCE_EXPIRY),
+            )
+        finally:
+            db.close()
+
+    def push_changes(self, changes: dict[int, bool]):
+        updates: dict[int, dict[int, bool]] = {}
+        for user_id, online in changes.items():
+            for friend_id in friend_graph.friends(user_id):
+                if friend_id in self.online:
+                    updates.setdefault(friend_id, {})[user_id] = online
+
+        for recipient_id, users in updates.items():
+            notifications.enqueue(
+                recipient_id, json.dumps({"type": "presence", "users": users})
+            )
+
+    async def flush(self):
+        changes, self.pending = self.pending, {}
+        # Runs without changes too, it keeps this worker's rows from expiring
+        try:
+            presence = await run_in_threadpool(self.write_changes, changes)
+        except Exception:
+            # Keep the changes for the next flush unless already superseded
+            self.pending = {**changes, **self.pending}
+            raise
+        self.push_changes(presence)
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Presence flush failed")
+
+    def start(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_loop())
+
+    async def stop(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        for user_id in list(self.online):
+            self.mark_offline(user_id)
+        await self.flush()
+
+
+presence = PresenceTracker()
@@ -0,0 +1,128 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Attach X-DB-Query-Count / X-DB-Time-Ms headers to every response
+QUERY_DEBUG_HEADERS = False
+# Warn when a single request issues more statements than this
+QUERY_BUDGET = 25
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    __slots__ = ("count", "total_time")
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+
+    @property
+    def total_time_ms(self) -> float:
+        return self.total_time * 1000
+
+
+_current_stats: ContextVar[QueryStats | None] = ContextVar(
+    "current_query_stats", default=None
+)
+
+
+def instrument_engine(engine: Engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start_time"].pop()
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.count += 1
+            stats.total_time += time.perf_counter() - started
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        start_times = exception_context.connection.info.get("query_start_time")
+        if start_times:
+            start_times.pop()
+
+
+@contextmanager
+def count_queries():
+    stats = QueryStats()
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def check_budget(request, stats: QueryStats):
+    if stats.count > QUERY_BUDGET:
+        logger.warning(
+            "%s %s issued %d queries (budget %d, %.1f ms in DB)",
+            request.method,
+            request.url.path,
+            stats.count,
+            QUERY_BUDGET,
+            stats.total_time_ms,
+        )
+
+
+async def count_body(request, stats: QueryStats, body_iterator):
+    # The endpoint task inherited the request's stats, so queries made while a
+    # StreamingResponse body is generated are counted after call_next returns
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        check_budget(request, stats)
+
+
+async def query_counter_middleware(request, call_next):
+    with count_queries() as stats:
+        response = await call_next(request)
+
+    # Only complete bodies have their final count by now, streamed ones are
+    # checked against the budget once they are done
+    if QUERY_DEBUG_HEADERS and "content-length" in response.headers:
+        response.headers["X-DB-Query-Count"] = str(stats.count)
+        response.headers["X-DB-Time-Ms"] = f"{stats.total_time_ms:.2f}"
+    response.body_iterator = count_body(request, stats, response.body_iterator)
+    return response
+
+
+# Test mode ------------------------------------------------------------------
+
+
+def assert_constant_query_count(
+    run: Callable[[], object],
+    seed: Callable[[int], object],
+    sizes: Iterable[int] = (1, 5, 25),
+):
+    # seed(size) grows the dataset, run() exercises the code under test. Fails
+    # when the number of statements depends on the amount of data (N+1).
+    # When run() returns a response with X-DB-Query-Count (QUERY_DEBUG_HEADERS
+    # on), that count is used, so routes can be checked through a TestClient
+    # which serves the app outside the caller's context.
+    counts = {}
+    for size in sizes:
+        seed(size)
+        with count_queries() as stats:
+            result = run()
+        headers = getattr(result, "headers", None)
+        if headers is not None and "X-DB-Query-Count" in headers:
+            counts[size] = int(headers["X-DB-Query-Count"])
+        else:
+            counts[size] = stats.count
+
+    if len(set(counts.values())) > 1:
+        raise AssertionError(f"Query count grows with data size: {counts}")
+    return counts
@@ -0,0 +1,156 @@
+import hashlib
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request
+
+# Upper bound on buckets kept by the in-memory store, least recently used
+# buckets are dropped first (a dropped bucket simply starts full again)
+MAX_IN_MEMORY_BUCKETS = 100_000
+
+
+class TokenBucketStore(ABC):
+    # Takes one token from the bucket under `key`. Returns 0 when a token was
+    # taken, otherwise the number of seconds until one becomes available.
+    @abstractmethod
+    async def take(self, key: str, rate: float, capacity: int) -> float:
+        ...
+
+
+class InMemoryTokenBucketStore(TokenBucketStore):
+    def __init__(self, max_buckets: int = MAX_IN_MEMORY_BUCKETS):
+        self.max_buckets = max_buckets
+        # key -> [tokens, last refill timestamp]
+        self.buckets: OrderedDict[str, list[float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    async def take(self, key: str, rate: float, capacity: int) -> float:
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = [float(capacity), now]
+                self.buckets[key] = bucket
+                if len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+
+class RedisTokenBucketStore(TokenBucketStore):
+    # Shared store for multi-worker deployments. Takes a redis.asyncio client,
+    # the refill and take happen atomically inside a Lua script.
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+    redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, client, prefix: str = "snailmail:ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    async def take(self, key: str, rate: float, capacity: int) -> float:
+        wait = await self.client.eval(
+            self.SCRIPT, 1, self.prefix + key, rate, capacity, time.time()
+        )
+        return float(wait)
+
+
+store: TokenBucketStore = InMemoryTokenBucketStore()
+
+
+def use_store(new_store: TokenBucketStore):
+    global store
+    store = new_store
+
+
+def authorization_key(authorization: str) -> str:
+    return hashlib.sha256(authorization.encode()).hexdigest()[:32]
+
+
+def token_key(request: Request) -> str | None:
+    # Keyed on the bearer token so the limit applies before any Fief or DB
+    # lookup is made to resolve the user
+    authorization = request.headers.get("Authorization")
+    if not authorization:
+        return None
+    return authorization_key(authorization)
+
+
+class RateLimit:
+    def __init__(
+        self,
+        scope: str,
+        user_rate: float,
+        user_capacity: int,
+        ip_rate: float,
+        ip_capacity: int,
+    ):
+        self.scope = scope
+        self.user_rate = user_rate
+        self.user_capacity = user_capacity
+        self.ip_rate = ip_rate
+        self.ip_capacity = ip_capacity
+
+    async def __call__(self, request: Request):
+        wait = await self.take(
+            ip=request.client.host if request.client is not None else None,
+            user_key=token_key(request),
+        )
+        if wait:
+            self.reject(wait)
+
+    async def take(self, ip: str | None, user_key: str | None) -> float:
+        # Same buckets for HTTP requests and websocket frames, returns 0 when
+        # allowed, otherwise the seconds to wait
+        if ip is not None:
+            wait = await store.take(
+                f"{self.scope}:ip:{ip}", self.ip_rate, self.ip_capacity
+            )
+            if wait:
+                return wait
+
+        if user_key is not None:
+            return await store.take(
+                f"{self.scope}:user:{user_key}", self.user_rate, self.user_capacity
+            )
+        return 0
+
+    def reject(self, wait: float):
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+
+send_message_rate_limit = RateLimit(
+    "send_message", user_rate=2, user_capacity=20, ip_rate=10, ip_capacity=60
+)
+friendship_request_rate_limit = RateLimit(
+    "friendship_request", user_rate=0.2, user_capacity=10, ip_rate=1, ip_capacity=30
+)
@@ -1,5 +1,5 @@
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
 
 # Messages
 
@@ -53,9 +53,23 @@ class UserDisplay(BaseModel):
         orm_mode = True
 
 
+class FriendSuggestion(UserDisplay):
+    mutual_friend_count: int
+
+
+class MutualFriends(BaseModel):
+    user_id: int
+    mutual_friend_count: int
+
+
 class UserId(BaseModel):
     id: int
 
+
+class UserIds(BaseModel):
+    ids: conlist(int, min_items=1, max_items=1000)
+
+
 class SendMessageSchema(BaseModel):
     content: str
 
@@ -0,0 +1,87 @@
+import heapq
+import zlib
+from contextlib import contextmanager
+from typing import Iterable
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from .message_cache import conversation_key
+from .query_counter import instrument_engine
+
+# Databases holding the messages table, a conversation lives on the shard
+# picked by a hash of its user pair. Empty keeps messages in the main
+# database. SQLite files work for local testing, e.g.
+# ["sqlite:///shard0.db", "sqlite:///shard1.db"]. Changing the number of
+# shards remaps conversations, existing messages have to be moved.
+MESSAGE_SHARD_URLS: list[str] = []
+
+
+class ShardSet:
+    def __init__(self, urls: list[str]):
+        self.engines: list[Engine] = []
+        self.sessionmakers: list[sessionmaker] = []
+        for url in urls:
+            shard_engine = create_engine(url, pool_pre_ping=True)
+            instrument_engine(shard_engine)
+            self.engines.append(shard_engine)
+            self.sessionmakers.append(
+                sessionmaker(autocommit=False, autoflush=False, bind=shard_engine)
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.engines)
+
+    def shard_index(self, user_id: int, friend_id: int) -> int:
+        # crc32 rather than hash() so every worker maps a pair to the same shard
+        first, second = conversation_key(user_id, friend_id)
+        return zlib.crc32(f"{first}:{second}".encode()) % len(self.engines)
+
+    def open_session(self, index: int) -> Session:
+        shard_db = self.sessionmakers[index]()
+        shard_db.info["shard"] = index
+        return shard_db
+
+    @contextmanager
+    def session_for(self, db: Session, user_id: int, friend_id: int):
+        # Session holding the conversation, db itself when not sharded or when
+        # db already is that shard's session
+        if not self.enabled:
+            yield db
+            return
+
+        index = self.shard_index(user_id, friend_id)
+        if db.info.get("shard") == index:
+            yield db
+            return
+
+        shard_db = self.open_session(index)
+        try:
+            yield shard_db
+        finally:
+            shard_db.close()
+
+    @contextmanager
+    def all_sessions(self, db: Session):
+        if not self.enabled:
+            yield [db]
+            return
+
+        shard_dbs = [self.open_session(index) for index in range(len(self.engines))]
+        try:
+            yield shard_dbs
+        finally:
+            for shard_db in shard_dbs:
+                shard_db.close()
+
+
+def merge_by_time(results: Iterable[Iterable]):
+    # k-way merge of per-shard results that are each ordered by time
+    return heapq.merge(
+        *results, key=lambda message: (message.created_datetime, message.id)
+    )
+
+
+shards = ShardSet(MESSAGE_SHARD_URLS)
@@ -0,0 +1,95 @@
+import zlib
+from typing import Iterable, Iterator
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        quality = params.strip().removeprefix("q=")
+        try:
+            if params and float(quality) == 0:
+                continue
+        except ValueError:
+            pass
+        accepted.add(coding.strip().lower())
+
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def encode_ndjson(items: Iterable[BaseModel]) -> Iterator[bytes]:
+    for item in items:
+        yield item.json().encode() + b"\n"
+
+
+def encode_json_array(
+    items: Iterable[BaseModel], prefix: str = "", suffix: str = ""
+) -> Iterator[bytes]:
+    yield (prefix + "[").encode()
+    separator = b""
+    for item in items:
+        yield separator + item.json().encode()
+        separator = b","
+    yield ("]" + suffix).encode()
+
+
+def compress(chunks: Iterable[bytes], encoding: str | None) -> Iterator[bytes]:
+    if encoding is None:
+        yield from chunks
+        return
+
+    if encoding == "br":
+        compressor = brotli.Compressor()
+        compress_chunk, flush = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(wbits=31)  # gzip container
+        compress_chunk, flush = compressor.compress, compressor.flush
+
+    for chunk in chunks:
+        compressed = compress_chunk(chunk)
+        if compressed:
+            yield compressed
+    yield flush()
+
+
+def stream_models(
+    request: Request,
+    rows: Iterable,
+    schema: type[BaseModel],
+    prefix: str = "",
+    suffix: str = "",
+) -> StreamingResponse:
+    # rows should come from a yield_per() query so they are fetched through a
+    # server-side cursor and never held in memory all at once
+    items = (schema.from_orm(row) for row in rows)
+
+    if NDJSON_MEDIA_TYPE in request.headers.get("Accept", ""):
+        media_type = NDJSON_MEDIA_TYPE
+        chunks = encode_ndjson(items)
+    else:
+        media_type = "application/json"
+        chunks = encode_json_array(items, prefix=prefix, suffix=suffix)
+
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+
+    return StreamingResponse(
+        compress(chunks, encoding), media_type=media_type, headers=headers
+    )
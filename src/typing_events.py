@@ -0,0 +1,105 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+from .connections import connections
+from .notifications import notifications
+
+# At most one typing event per (sender, recipient) pair in this many seconds,
+# state changes within the window are coalesced into one trailing event.
+# Clients should drop an indicator not refreshed within a few intervals.
+TYPING_THROTTLE_INTERVAL = 2
+# (sender, recipient) pairs whose typing state is remembered
+TRACKED_TYPING_PAIRS = 10_000
+
+
+class TypingPair:
+    __slots__ = ("typing", "sent_typing", "last_sent", "flush_handle")
+
+    def __init__(self):
+        # Latest state reported by the sender and the last one pushed
+        self.typing = False
+        self.sent_typing = False
+        self.last_sent = 0.0
+        self.flush_handle: asyncio.TimerHandle | None = None
+
+
+class TypingEvents:
+    # Ephemeral typing/stop-typing events, never written to the database.
+    # Events only go to the recipient's sockets on this worker, with no live
+    # socket there is nobody to show the indicator to and they are dropped.
+    # They are queued as ephemeral notifications and never push out messages.
+    def __init__(self, max_pairs: int = TRACKED_TYPING_PAIRS):
+        self.max_pairs = max_pairs
+        self.pairs: OrderedDict[tuple[int, int], TypingPair] = OrderedDict()
+        self.sent = 0
+        self.coalesced = 0
+
+    def get_pair(self, key: tuple[int, int]) -> TypingPair:
+        pair = self.pairs.get(key)
+        if pair is None:
+            pair = self.pairs[key] = TypingPair()
+            if len(self.pairs) > self.max_pairs:
+                _, evicted = self.pairs.popitem(last=False)
+                if evicted.flush_handle is not None:
+                    evicted.flush_handle.cancel()
+        self.pairs.move_to_end(key)
+        return pair
+
+    def publish(self, sender_id: int, recipient_id: int, typing: bool):
+        key = (sender_id, recipient_id)
+        pair = self.get_pair(key)
+        pair.typing = typing
+        if pair.flush_handle is not None:
+            # The trailing event will carry the latest state
+            self.coalesced += 1
+            return
+
+        wait = pair.last_sent + TYPING_THROTTLE_INTERVAL - time.monotonic()
+        if wait <= 0:
+            # Repeating the current state refreshes the recipient's indicator
+            self.send(key, pair)
+        elif typing == pair.sent_typing:
+            self.coalesced += 1
+        else:
+            pair.flush_handle = asyncio.get_running_loop().call_later(
+                wait, self.flush, key
+            )
+
+    def flush(self, key: tuple[int, int]):
+        pair = self.pairs.get(key)
+        if pair is None:
+            return
+        pair.flush_handle = None
+        if pair.typing != pair.sent_typing:
+            self.send(key, pair)
+
+    def send(self, key: tuple[int, int], pair: TypingPair):
+        sender_id, recipient_id = key
+        pair.sent_typing = pair.typing
+        pair.last_sent = time.monotonic()
+        if not connections.user_connections(recipient_id):
+            return
+        notifications.enqueue(
+            recipient_id,
+            json.dumps({"type": "typing", "user_id": sender_id, "typing": pair.typing}),
+            ephemeral=True,
+        )
+        self.sent += 1
+
+    def message_sent(self, sender_id: int, recipient_id: int):
+        # The message itself ends the indicator on the recipient's side
+        pair = self.pairs.pop((sender_id, recipient_id), None)
+        if pair is not None and pair.flush_handle is not None:
+            pair.flush_handle.cancel()
+
+    def metrics(self) -> dict:
+        return {
+            "tracked_pairs": len(self.pairs),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+        }
+
+
+typing_events = TypingEvents()
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+# Seconds to wait before retrying a warm-up step that failed
+WARMUP_RETRY_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+
+class WarmupState:
+    def __init__(self):
+        self.steps: dict[str, Callable[[], Awaitable]] = {}
+        self.done: set[str] = set()
+        self.errors: dict[str, str] = {}
+        self.task: asyncio.Task | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.done.issuperset(self.steps)
+
+    def pending(self) -> list[str]:
+        return [name for name in self.steps if name not in self.done]
+
+    def step(self, name: str):
+        def register(func: Callable[[], Awaitable]):
+            self.steps[name] = func
+            return func
+
+        return register
+
+    async def run_step(self, name: str):
+        while True:
+            try:
+                await self.steps[name]()
+            except Exception as error:
+                self.errors[name] = repr(error)
+                logger.warning("Warm-up step %s failed: %r", name, error)
+                await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+            else:
+                self.errors.pop(name, None)
+                self.done.add(name)
+                return
+
+    async def run(self):
+        await asyncio.gather(*(self.run_step(name) for name in self.pending()))
+
+    def start(self):
+        # Runs in the background so the worker boots even while a dependency
+        # is down, /ready/ reports when everything is warm
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+
+warmup = WarmupState()
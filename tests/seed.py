@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from src import models
+
+START = datetime(2022, 1, 1)
+
+
+def add_users(db, user_ids):
+    db.execute(
+        insert(models.User),
+        [
+            {
+                "id": user_id,
+                "user_email": f"user{user_id}@example.com",
+                "user_name": f"user{user_id}",
+            }
+            for user_id in user_ids
+        ],
+    )
+    db.commit()
+
+
+def add_friendship(db, requester_id, adressee_id, status_codes=("R", "A")):
+    # FriendshipStatus has its server default timestamp in the primary key,
+    # which SQLite can't return, so statuses get explicit timestamps
+    db.execute(
+        insert(models.Friendship).values(
+            requester_id=requester_id, adressee_id=adressee_id, created_datetime=START
+        )
+    )
+    db.execute(
+        insert(models.FriendshipStatus),
+        [
+            {
+                "requester_id": requester_id,
+                "adressee_id": adressee_id,
+                "specifier_id": requester_id if status_code == "R" else adressee_id,
+                "status_code": status_code,
+                "created_datetime": START + timedelta(minutes=offset),
+            }
+            for offset, status_code in enumerate(status_codes)
+        ],
+    )
+    db.commit()
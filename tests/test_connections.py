@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from src import connections as connections_module
+from src.connections import ConnectionManager
+from src.presence import PresenceTracker
+
+
+class FakeWebSocket:
+    def __init__(self, stuck=False):
+        self.stuck = stuck
+        self.sent = []
+        self.closed = False
+
+    async def send_text(self, text):
+        if self.stuck:
+            await asyncio.sleep(3600)
+        self.sent.append(text)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(connections_module, "presence", PresenceTracker())
+    monkeypatch.setattr(connections_module, "HEARTBEAT_INTERVAL", 0)
+    monkeypatch.setattr(connections_module, "HEARTBEAT_SEND_TIMEOUT", 0.05)
+    return ConnectionManager()
+
+
+async def serve(manager, user_id, websocket, heartbeat=False):
+    # Like the websocket endpoint, each socket is served by its own task
+    async def handler():
+        manager.append_connection(user_id, websocket, heartbeat=heartbeat)
+        await asyncio.sleep(3600)
+
+    task = asyncio.create_task(handler())
+    await asyncio.sleep(0)
+    return task
+
+
+async def one_heartbeat(manager):
+    task = asyncio.create_task(manager.heartbeat())
+    await asyncio.sleep(0.2)
+    task.cancel()
+
+
+def test_pings_only_clients_that_opted_in(manager):
+    legacy, opted_in = FakeWebSocket(), FakeWebSocket()
+
+    async def scenario():
+        await serve(manager, 1, legacy)
+        await serve(manager, 1, opted_in, heartbeat=True)
+        await one_heartbeat(manager)
+
+    asyncio.run(scenario())
+
+    assert legacy.sent == [] and not legacy.closed
+    assert "ping" in opted_in.sent
+    assert len(manager.user_connections(1)) == 2
+
+
+def test_stuck_socket_is_reaped_without_holding_up_others(manager):
+    stuck, healthy = FakeWebSocket(stuck=True), FakeWebSocket()
+
+    async def scenario():
+        stuck_task = await serve(manager, 1, stuck, heartbeat=True)
+        await serve(manager, 2, healthy, heartbeat=True)
+        await one_heartbeat(manager)
+        return stuck_task
+
+    stuck_task = asyncio.run(scenario())
+
+    assert stuck.closed and stuck_task.cancelled()
+    assert manager.user_connections(1) == []
+    assert "ping" in healthy.sent
+
+
+def test_connection_caps(manager, monkeypatch):
+    monkeypatch.setattr(connections_module, "MAX_CONNECTIONS_PER_USER", 1)
+
+    async def scenario():
+        first = manager.append_connection(1, FakeWebSocket())
+        second = manager.append_connection(1, FakeWebSocket())
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first is not None and second is None
+    assert manager.connection_count == 1
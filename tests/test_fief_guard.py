@@ -0,0 +1,129 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from src import fief_guard
+from src.fief_guard import CircuitBreaker, GuardedFief
+
+
+@pytest.fixture
+def clock(fake_clock, monkeypatch):
+    fake_clock.install(monkeypatch, fief_guard)
+    return fake_clock
+
+
+def status_error(status_code):
+    request = httpx.Request("GET", "https://fief.example.com/api/userinfo")
+    return httpx.HTTPStatusError(
+        "userinfo failed",
+        request=request,
+        response=httpx.Response(status_code, request=request),
+    )
+
+
+class FakeFief:
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    async def userinfo(self, access_token):
+        self.calls += 1
+        await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+        return {"email": f"{access_token}@example.com"}
+
+
+def userinfo(guarded, access_token="token"):
+    return asyncio.run(guarded.userinfo(access_token))
+
+
+def test_breaker_opens_after_threshold_and_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    # A failed trial opens the circuit again right away
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.metrics()["times_opened"] == 2
+
+
+def test_only_server_errors_and_timeouts_count_as_outages():
+    assert fief_guard.is_fief_outage(status_error(503))
+    assert fief_guard.is_fief_outage(asyncio.TimeoutError())
+    assert fief_guard.is_fief_outage(httpx.ConnectError("refused"))
+    assert not fief_guard.is_fief_outage(status_error(401))
+    assert not fief_guard.is_fief_outage(ValueError())
+
+
+def test_rejected_token_is_passed_on_without_opening_the_circuit(clock):
+    client = FakeFief()
+    client.error = status_error(401)
+    guarded = GuardedFief(client)
+    for _ in range(fief_guard.FIEF_FAILURE_THRESHOLD + 1):
+        with pytest.raises(httpx.HTTPStatusError):
+            userinfo(guarded)
+    assert guarded.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cached_identity_is_served_while_fief_is_down(clock):
+    client = FakeFief()
+    guarded = GuardedFief(client)
+    assert userinfo(guarded) == {"email": "token@example.com"}
+    assert userinfo(guarded) == {"email": "token@example.com"}
+    assert client.calls == 1
+
+    client.error = status_error(502)
+    clock.now += fief_guard.USERINFO_FRESH_TTL + 1
+    for _ in range(fief_guard.FIEF_FAILURE_THRESHOLD):
+        assert userinfo(guarded) == {"email": "token@example.com"}
+    assert guarded.breaker.state == CircuitBreaker.OPEN
+
+    # Open circuit, Fief isn't asked
+    calls = client.calls
+    assert userinfo(guarded) == {"email": "token@example.com"}
+    assert client.calls == calls
+    with pytest.raises(HTTPException) as error:
+        userinfo(guarded, access_token="unknown")
+    assert error.value.status_code == 503
+
+
+def test_concurrent_calls_for_one_token_share_a_request():
+    client = FakeFief()
+    guarded = GuardedFief(client)
+
+    async def scenario():
+        return await asyncio.gather(*(guarded.userinfo("token") for _ in range(5)))
+
+    assert asyncio.run(scenario()) == [{"email": "token@example.com"}] * 5
+    assert client.calls == 1
+    assert guarded.coalesced == 4
+
+
+def test_prefetch_keys_loads_configuration_then_jwks():
+    calls = []
+
+    class KeyedFief:
+        async def _get_openid_configuration(self):
+            calls.append("openid_configuration")
+
+        async def _get_jwks(self):
+            calls.append("jwks")
+
+    asyncio.run(GuardedFief(KeyedFief()).prefetch_keys())
+    assert calls == ["openid_configuration", "jwks"]
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+
+from src import crud
+from src.friend_graph import FriendGraph, intersection_size
+
+from .seed import add_friendship, add_users
+
+
+def test_intersection_size():
+    assert intersection_size([1, 3, 5, 7], [2, 3, 4, 7, 9]) == 2
+    assert intersection_size([], [1]) == 0
+
+
+def loaded_graph():
+    graph = FriendGraph()
+    graph.load([(1, 2), (1, 3), (2, 3), (3, 4), (2, 5), (3, 5)])
+    return graph
+
+
+def test_mutual_friends_and_suggestions():
+    graph = loaded_graph()
+    assert graph.are_friends(2, 1) and not graph.are_friends(1, 4)
+    assert graph.mutual_friend_count(1, 5) == 2
+    assert graph.suggestions(1, 10) == [(5, 2), (4, 1)]
+
+
+def test_changes_invalidate_cached_results():
+    graph = loaded_graph()
+    assert graph.suggestions(1, 10) == [(5, 2), (4, 1)]
+    assert graph.mutual_friend_count(1, 4) == 1
+
+    graph.add_friendship(1, 5)
+    assert graph.suggestions(1, 10) == [(4, 1)]
+    graph.remove_friendship(3, 4)
+    assert graph.mutual_friend_count(1, 4) == 0
+    assert graph.suggestions(1, 10) == []
+
+
+def test_changes_during_rebuild_are_kept():
+    graph = loaded_graph()
+
+    def fetch_accepted_pairs():
+        # Snapshot taken before the changes below were committed
+        pairs = [(1, 2), (1, 3)]
+        graph.add_friendship(1, 4)
+        graph.remove_friendship(1, 2)
+        return pairs
+
+    graph.rebuild(fetch_accepted_pairs)
+    assert list(graph.friends(1)) == [3, 4]
+    assert graph.pending_changes is None
+
+
+def test_failed_rebuild_keeps_graph():
+    graph = loaded_graph()
+
+    def fetch_accepted_pairs():
+        raise RuntimeError("database down")
+
+    try:
+        graph.rebuild(fetch_accepted_pairs)
+    except RuntimeError:
+        pass
+    assert list(graph.friends(1)) == [2, 3]
+    assert graph.pending_changes is None
+
+
+def test_concurrent_refreshes_share_one_rebuild():
+    graph = FriendGraph()
+    calls = []
+    release = threading.Event()
+
+    def load():
+        calls.append(1)
+        release.wait(5)
+        graph.load([(1, 2)])
+
+    async def scenario():
+        refreshes = [asyncio.create_task(graph.refresh(load)) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        # The old (empty) graph keeps being served during the rebuild
+        assert not graph.are_friends(1, 2)
+        release.set()
+        await asyncio.gather(*refreshes)
+
+    asyncio.run(scenario())
+    assert len(calls) == 1
+    assert graph.are_friends(1, 2)
+
+
+def test_load_from_database(db, monkeypatch):
+    graph = FriendGraph()
+    monkeypatch.setattr(crud, "friend_graph", graph)
+    add_users(db, [1, 2, 3, 4])
+    add_friendship(db, 1, 2)
+    add_friendship(db, 3, 1, status_codes=("R",))
+    add_friendship(db, 4, 1, status_codes=("R", "A", "B"))
+
+    crud.load_friend_graph(db=db)
+    assert list(graph.friends(1)) == [2]
+
+
+def test_are_friends_reads_the_latest_status(db):
+    add_users(db, [1, 2, 3])
+    add_friendship(db, 1, 2)
+    add_friendship(db, 1, 3, status_codes=("R", "A", "B"))
+
+    assert crud.are_friends(db=db, this_user=2, other_user=1)
+    assert not crud.are_friends(db=db, this_user=1, other_user=3)
+    assert not crud.are_friends(db=db, this_user=2, other_user=3)
+
+
+def test_suggestions_skip_users_with_any_friendship(db, monkeypatch):
+    graph = FriendGraph()
+    monkeypatch.setattr(crud, "friend_graph", graph)
+    add_users(db, [1, 2, 3, 4, 5, 6, 7])
+    add_friendship(db, 1, 2)
+    for friend_id in (3, 4, 5, 6, 7):
+        add_friendship(db, 2, friend_id)
+    add_friendship(db, 3, 1, status_codes=("R",))
+    add_friendship(db, 1, 4, status_codes=("R", "D"))
+    add_friendship(db, 5, 1, status_codes=("R", "A", "B"))
+    crud.load_friend_graph(db=db)
+
+    suggestions = crud.get_friend_suggestions(db=db, this_user=1, how_many=2)
+    assert [(user.id, mutual_count) for user, mutual_count in suggestions] == [
+        (6, 1),
+        (7, 1),
+    ]
@@ -0,0 +1,97 @@
+import pytest
+
+from src import crud, models
+from src.friend_graph import friend_graph
+from src.query_counter import count_queries
+
+from .seed import add_friendship, add_users
+
+
+@pytest.fixture(autouse=True)
+def graph():
+    friend_graph.load([])
+    yield friend_graph
+    friend_graph.load([])
+
+
+def latest_codes(db, this_user, other_users):
+    pairs = [(other_user, this_user) for other_user in other_users]
+    pairs += [(this_user, other_user) for other_user in other_users]
+    return {
+        pair: status.status_code
+        for pair, status in crud.get_latest_friendship_statuses(
+            db=db, pairs=pairs
+        ).items()
+    }
+
+
+def test_nothing_is_written_when_any_id_is_invalid(db):
+    add_users(db, [1, 2, 3, 4])
+    add_friendship(db, 2, 1, status_codes=("R",))
+    add_friendship(db, 3, 1)
+
+    statuses, invalid_ids = crud.accept_friendship_requests(
+        db=db, this_user=1, other_users=[2, 3, 4]
+    )
+    assert (statuses, invalid_ids) == ([], [3, 4])
+    assert latest_codes(db, 1, [2, 3]) == {(2, 1): "R", (3, 1): "A"}
+    assert not friend_graph.are_friends(1, 2)
+
+
+def test_repeated_ids_are_written_once(db, graph):
+    add_users(db, [1, 2, 3])
+    add_friendship(db, 2, 1, status_codes=("R",))
+    add_friendship(db, 3, 1, status_codes=("R",))
+
+    statuses, invalid_ids = crud.accept_friendship_requests(
+        db=db, this_user=1, other_users=[2, 3, 2, 2]
+    )
+    assert invalid_ids == []
+    assert [(status["requester_id"], status["status_code"]) for status in statuses] == [
+        (2, "A"),
+        (3, "A"),
+    ]
+    assert db.query(models.FriendshipStatus).count() == 4
+    assert graph.are_friends(1, 2) and graph.are_friends(3, 1)
+
+
+def test_block_applies_to_requests_in_either_direction(db, graph):
+    add_users(db, [1, 2, 3])
+    add_friendship(db, 1, 2)
+    add_friendship(db, 3, 1)
+    graph.load([(1, 2), (3, 1)])
+
+    statuses, invalid_ids = crud.block_friendships(
+        db=db, this_user=1, other_users=[2, 3]
+    )
+    assert invalid_ids == []
+    assert {
+        (status["requester_id"], status["adressee_id"], status["specifier_id"])
+        for status in statuses
+    } == {(1, 2, 1), (3, 1, 1)}
+    assert latest_codes(db, 1, [2, 3]) == {(1, 2): "B", (3, 1): "B"}
+    assert graph.friends(1).tolist() == []
+
+
+def test_deny_keeps_the_friend_graph_unchanged(db, graph):
+    add_users(db, [1, 2])
+    add_friendship(db, 2, 1, status_codes=("R",))
+
+    statuses, _ = crud.deny_friendship_requests(db=db, this_user=1, other_users=[2])
+    assert [status["status_code"] for status in statuses] == ["D"]
+    assert not graph.are_friends(1, 2)
+
+
+@pytest.mark.parametrize("size", [1, 5, 25])
+def test_one_select_and_one_insert_for_any_number_of_users(db, size):
+    other_users = list(range(2, size + 2))
+    add_users(db, [1, *other_users])
+    for other_user in other_users:
+        add_friendship(db, other_user, 1, status_codes=("R",))
+
+    with count_queries() as stats:
+        statuses, _ = crud.accept_friendship_requests(
+            db=db, this_user=1, other_users=other_users
+        )
+    assert len(statuses) == size
+    assert stats.count == 2
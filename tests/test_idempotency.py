@@ -0,0 +1,79 @@
+import pytest
+
+from src import crud, migrations, models, schemas
+
+from .seed import add_users
+
+
+@pytest.fixture(autouse=True)
+def unique_keys(engine):
+    # Created by migration 3, not by the models
+    migrations.message_idempotency_index.create(bind=engine)
+
+
+def send(db, sender_id, receiver_id, idempotency_key, content="hi"):
+    return crud.create_message_idempotent(
+        db=db,
+        message=schemas.MessageCreate(content=content),
+        sender_id=sender_id,
+        receiver_id=receiver_id,
+        idempotency_key=idempotency_key,
+    )
+
+
+def row(sender_id, receiver_id, idempotency_key, content="hi"):
+    return {
+        "content": content,
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "idempotency_key": idempotency_key,
+    }
+
+
+def test_retried_send_returns_the_original_message(db):
+    add_users(db, [1, 2])
+    first, created = send(db, 1, 2, "key", content="first")
+    assert created
+    retried, created = send(db, 1, 2, "key", content="retried")
+    assert not created
+    assert (retried.id, retried.content) == (first.id, "first")
+    assert db.query(models.Message).count() == 1
+
+
+def test_keys_are_per_sender(db):
+    add_users(db, [1, 2])
+    first, _ = send(db, 1, 2, "key")
+    other, created = send(db, 2, 1, "key")
+    assert created
+    assert other.id != first.id
+
+
+def test_batch_resolves_known_and_repeated_keys(db):
+    add_users(db, [1, 2])
+    existing, _ = send(db, 1, 2, "old", content="old")
+
+    results = crud.create_messages(
+        db=db,
+        messages=[
+            row(1, 2, "new", content="new"),
+            row(1, 2, "old", content="old again"),
+            row(1, 2, None, content="no key"),
+            row(1, 2, "new", content="new again"),
+        ],
+    )
+    assert [created for _, created in results] == [True, False, True, False]
+    new, old, no_key, new_again = (message for message, _ in results)
+    assert old["id"] == existing.id
+    assert new_again["id"] == new["id"]
+    assert (new_again["content"], no_key["content"]) == ("new", "no key")
+    assert db.query(models.Message).count() == 3
+
+
+def test_batch_without_repeats_creates_every_message(db):
+    add_users(db, [1, 2])
+    results = crud.create_messages(
+        db=db, messages=[row(1, 2, f"key {index}") for index in range(3)]
+    )
+    assert [created for _, created in results] == [True] * 3
+    ids = [message["id"] for message, _ in results]
+    assert ids == sorted(ids) and len(set(ids)) == 3
@@ -0,0 +1,155 @@
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import insert
+
+from src import crud, database, models
+from src import message_cache as message_cache_module
+from src.database import ReplicaRouter
+from src.message_cache import MessageCache
+
+from .seed import START, add_friendship, add_users
+
+
+class FakeMessage:
+    def __init__(self, id, sender_id=1, receiver_id=2):
+        self.id = id
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.created_datetime = START + timedelta(minutes=id)
+        self.content = f"message {id}"
+
+
+def as_dict(message):
+    return {
+        "id": message.id,
+        "sender_id": message.sender_id,
+        "receiver_id": message.receiver_id,
+        "created_datetime": message.created_datetime,
+        "content": message.content,
+    }
+
+
+def ids(messages):
+    return [message.id for message in messages]
+
+
+def test_cached_conversation_follows_writes():
+    cache = MessageCache()
+    cache.fill(1, 2, [FakeMessage(1), FakeMessage(2)], complete=True, snapshot=0)
+    cache.append(as_dict(FakeMessage(3, sender_id=2, receiver_id=1)))
+
+    assert ids(cache.get_recent(2, 1, 10, newest_id=3)) == [1, 2, 3]
+    assert ids(cache.get_recent(1, 2, 2, newest_id=3)) == [2, 3]
+
+
+def test_newer_message_in_the_db_invalidates_the_conversation():
+    cache = MessageCache()
+    cache.fill(1, 2, [FakeMessage(1)], complete=True, snapshot=0)
+
+    # Written through another worker
+    assert cache.get_recent(1, 2, 10, newest_id=4) is None
+    assert cache.conversations == {}
+    assert cache.total_size == 0
+
+
+def test_fill_after_concurrent_write_is_skipped():
+    cache = MessageCache()
+    snapshot = cache.snapshot()
+    cache.append(as_dict(FakeMessage(2)))
+    cache.fill(1, 2, [FakeMessage(1)], complete=True, snapshot=snapshot)
+    assert cache.get_recent(1, 2, 10, newest_id=2) is None
+
+
+def test_incomplete_conversation_only_serves_what_it_holds():
+    cache = MessageCache()
+    cache.fill(1, 2, [FakeMessage(5), FakeMessage(6)], complete=False, snapshot=0)
+    assert ids(cache.get_recent(1, 2, 2, newest_id=6)) == [5, 6]
+    assert cache.get_recent(1, 2, 3, newest_id=6) is None
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = MessageCache()
+    monkeypatch.setattr(crud, "message_cache", cache)
+    monkeypatch.setattr(message_cache_module, "message_cache", cache)
+    return cache
+
+
+def test_messages_from_other_workers_are_served(db, cache):
+    add_users(db, [1, 2])
+    add_friendship(db, 1, 2)
+    db.execute(insert(models.Message), [as_dict(FakeMessage(1))])
+    db.commit()
+    messages = crud.get_friend_messages_sorted(db=db, user_id=1, friend_id=2, limit=10)
+    assert ids(messages) == [1]
+    assert cache.conversations
+
+    # Not written through this worker's cache
+    db.execute(
+        insert(models.Message), [as_dict(FakeMessage(2, sender_id=2, receiver_id=1))]
+    )
+    db.commit()
+    messages = crud.get_friend_messages_sorted(db=db, user_id=1, friend_id=2, limit=10)
+    assert ids(messages) == [1, 2]
+
+
+def test_replica_reads_do_not_fill_the_cache(engine, db, cache, monkeypatch):
+    router = ReplicaRouter([])
+    router.engines.append(engine)
+    monkeypatch.setattr(database, "replica_router", router)
+    add_users(db, [1, 2])
+    db.execute(insert(models.Message), [as_dict(FakeMessage(1))])
+    db.commit()
+
+    read_db = database.ReadSessionLocal()
+    try:
+        messages = crud.get_friend_messages_sorted(
+            db=read_db, user_id=1, friend_id=2, limit=10
+        )
+    finally:
+        read_db.close()
+    assert ids(messages) == [1]
+    assert not cache.conversations
+
+
+def test_last_message_is_served_from_a_fresh_conversation():
+    cache = MessageCache()
+    messages = [FakeMessage(1), FakeMessage(2, sender_id=2, receiver_id=1)]
+    cache.fill(1, 2, messages, complete=True, snapshot=0)
+
+    found, message = cache.get_last_message_from(1, 2, newest_id=2)
+    assert found and message.id == 1
+    assert cache.get_last_message_from(2, 1, newest_id=2)[1].id == 2
+
+    # A newer message written through another worker
+    assert cache.get_last_message_from(1, 2, newest_id=3) == (False, None)
+    assert cache.conversations == {}
+
+
+def test_complete_conversation_knows_there_is_no_last_message():
+    cache = MessageCache()
+    cache.fill(1, 2, [FakeMessage(1)], complete=True, snapshot=0)
+    assert cache.get_last_message_from(2, 1, newest_id=1) == (True, None)
+
+    cache.fill(1, 2, [FakeMessage(1)], complete=False, snapshot=0)
+    assert cache.get_last_message_from(2, 1, newest_id=1) == (False, None)
+
+
+def test_last_message_checks_the_db_for_newer_messages(db, cache):
+    add_users(db, [1, 2])
+    db.execute(
+        insert(models.Message),
+        [as_dict(FakeMessage(id, sender_id=2, receiver_id=1)) for id in (1, 2)],
+    )
+    db.commit()
+    crud.get_friend_messages_sorted(db=db, user_id=1, friend_id=2, limit=10)
+    assert crud.get_friend_last_message(db=db, user_id=1, friend_id=2).id == 2
+
+    # Not written through this worker's cache
+    db.execute(
+        insert(models.Message), [as_dict(FakeMessage(3, sender_id=2, receiver_id=1))]
+    )
+    db.commit()
+    assert crud.get_friend_last_message(db=db, user_id=1, friend_id=2).id == 3
+    assert crud.get_friend_last_message(db=db, user_id=2, friend_id=1) is None
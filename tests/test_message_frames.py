@@ -0,0 +1,142 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src import crud, message_batcher as message_batcher_module
+from src import message_frames as message_frames_module
+from src.idempotency import IdempotencyCache
+from src.message_batcher import MessageBatcher
+from src.database import Base
+from src.message_frames import MessageFrames
+
+from .seed import add_friendship, add_users
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, text):
+        await asyncio.sleep(0)
+        self.sent.append(json.loads(text))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.websocket = FakeWebSocket()
+
+
+class FakeNotifications:
+    def __init__(self):
+        self.notified = []
+
+    def notify_user_of_message(self, sender_id, recipient_id):
+        self.notified.append((sender_id, recipient_id))
+
+
+@pytest.fixture
+def engine(tmp_path):
+    # Friend checks and batch inserts run at the same time in different
+    # threads, they need a connection each like with the real pool
+    test_engine = create_engine(
+        f"sqlite:///{tmp_path / 'main.db'}", connect_args={"check_same_thread": False}
+    )
+    Base.metadata.create_all(bind=test_engine)
+    yield test_engine
+    test_engine.dispose()
+
+
+@pytest.fixture
+def notified(engine, monkeypatch):
+    session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(message_frames_module, "SessionLocal", session_local)
+    monkeypatch.setattr(message_batcher_module, "SessionLocal", session_local)
+    # Several batches, some flushed full and some by the window
+    monkeypatch.setattr(message_batcher_module, "MESSAGE_BATCH_SIZE", 3)
+    monkeypatch.setattr(message_frames_module, "message_batcher", MessageBatcher())
+    monkeypatch.setattr(message_frames_module, "idempotency_cache", IdempotencyCache())
+    fake_notifications = FakeNotifications()
+    monkeypatch.setattr(message_frames_module, "notifications", fake_notifications)
+    return fake_notifications.notified
+
+
+def send_frames(frames):
+    connection = FakeConnection()
+
+    async def scenario():
+        message_frames = MessageFrames(connection, 1, (None, None))
+        message_frames.start()
+        for frame in frames:
+            message_frames.put(frame)
+        await message_frames.close()
+
+    asyncio.run(scenario())
+    return connection.websocket.sent
+
+
+def message_frame(index, friend_id=2):
+    return {
+        "type": "message",
+        "client_id": f"frames-{index}",
+        "friend_id": friend_id,
+        "content": f"message {index}",
+    }
+
+
+def test_pipelined_frames_are_acked_and_stored_in_order(db, notified):
+    add_users(db, [1, 2])
+    add_friendship(db, 1, 2)
+
+    replies = send_frames([message_frame(index) for index in range(8)])
+    assert [reply["type"] for reply in replies] == ["ack"] * 8
+    assert [reply["client_id"] for reply in replies] == [
+        f"frames-{index}" for index in range(8)
+    ]
+    acked_ids = [reply["id"] for reply in replies]
+    assert acked_ids == sorted(acked_ids)
+
+    # Rows of one insert share their timestamp, the id keeps them in order
+    history = crud.get_friend_messages_sorted(db=db, user_id=2, friend_id=1)
+    assert [message.id for message in history] == acked_ids
+    assert [message.content for message in history] == [
+        f"message {index}" for index in range(8)
+    ]
+    assert notified == [(1, 2)] * 8
+
+
+def test_rejected_frames_are_answered_in_their_place(db, notified):
+    add_users(db, [1, 2, 3])
+    add_friendship(db, 1, 2)
+
+    replies = send_frames(
+        [
+            message_frame(0),
+            message_frame(1, friend_id=3),
+            {"type": "message", "client_id": "frames-2"},
+            message_frame(3),
+        ]
+    )
+    assert [(reply["client_id"], reply["type"]) for reply in replies] == [
+        ("frames-0", "ack"),
+        ("frames-1", "error"),
+        ("frames-2", "error"),
+        ("frames-3", "ack"),
+    ]
+    assert [reply["detail"] for reply in replies if reply["type"] == "error"] == [
+        "Forbidden",
+        "Bad request",
+    ]
+
+
+def test_too_long_client_id_is_rejected(db, notified):
+    add_users(db, [1, 2])
+    add_friendship(db, 1, 2)
+
+    frame = message_frame(0)
+    frame["client_id"] = "x" * 65
+    replies = send_frames([frame])
+    assert [reply["detail"] for reply in replies] == ["client_id is too long"]
+    assert crud.get_friend_messages_sorted(db=db, user_id=1, friend_id=2) == []
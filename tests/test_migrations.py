@@ -0,0 +1,93 @@
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import Session
+
+from src import crud, migrations, models
+
+
+def index_names(engine, table_name):
+    # Read from sqlite_master, reflection skips expression indexes
+    with engine.connect() as connection:
+        return set(
+            connection.execute(
+                text(
+                    "SELECT name FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = :table_name"
+                ),
+                {"table_name": table_name},
+            ).scalars()
+        )
+
+
+def test_fresh_database_is_migrated_to_the_latest_version(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'main.db'}")
+    assert migrations.run_migrations(engine=engine) == migrations.MIGRATIONS[-1][0]
+    assert {
+        "uq_messages_sender_idempotency_key",
+        "ix_messages_conversation_pair",
+        "ix_messages_conversation_direction",
+    } <= index_names(engine, "messages")
+    # Nothing left to apply on the next deploy
+    assert migrations.run_migrations(engine=engine) == migrations.MIGRATIONS[-1][0]
+
+
+def test_database_from_before_the_idempotency_key_is_upgraded(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'main.db'}")
+    with engine.begin() as connection:
+        models.Base.metadata.create_all(bind=connection)
+        connection.execute(text("ALTER TABLE messages DROP COLUMN idempotency_key"))
+        migrations.get_schema_version(connection)
+        connection.execute(migrations.schema_version.insert().values(version=1))
+
+    migrations.run_migrations(engine=engine)
+    columns = {column["name"] for column in inspect(engine).get_columns("messages")}
+    assert "idempotency_key" in columns
+    assert {
+        "ix_messages_conversation",
+        "uq_messages_sender_idempotency_key",
+    } <= index_names(engine, "messages")
+
+
+def test_conversation_query_walks_the_pair_index_without_sorting(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'main.db'}")
+    migrations.run_migrations(engine=engine)
+    db = Session(bind=engine)
+    try:
+        queries = [
+            crud.query_friend_messages_sorted(
+                db=db, user_id=2, friend_id=1, newest_first=newest_first
+            )
+            for newest_first in (False, True)
+        ]
+        queries.append(
+            crud.query_friend_newest_message_id(db=db, user_id=2, friend_id=1)
+        )
+        for query in queries:
+            statement = query.statement.compile(
+                dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+            )
+            details = [
+                row[-1] for row in db.execute(text(f"EXPLAIN QUERY PLAN {statement}"))
+            ]
+            assert any("ix_messages_conversation_pair" in row for row in details)
+            assert not any("TEMP B-TREE" in row for row in details)
+    finally:
+        db.close()
+
+
+def test_users_are_offline_once_presence_is_tracked(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'main.db'}")
+    with engine.begin() as connection:
+        models.Base.metadata.create_all(bind=connection)
+        models.UserPresence.__table__.drop(bind=connection)
+        connection.execute(
+            models.User.__table__.insert().values(
+                id=1, user_email="user1@example.com", user_name="user1", is_online=True
+            )
+        )
+        migrations.get_schema_version(connection)
+        connection.execute(migrations.schema_version.insert().values(version=3))
+
+    migrations.run_migrations(engine=engine)
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT is_online FROM users")).scalar() == 0
+        assert inspect(connection).has_table("user_presence")
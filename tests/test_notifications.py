@@ -0,0 +1,106 @@
+import asyncio
+
+from src import notifications as notifications_module
+from src.notifications import NotificationDispatcher
+
+
+class FakeWebSocket:
+    def __init__(self, log, recipient_id):
+        self.log = log
+        self.recipient_id = recipient_id
+        self.sending = False
+
+    async def send_text(self, text):
+        assert not self.sending, "concurrent sends on one socket"
+        self.sending = True
+        # Later notifications finish faster, reordering would show up
+        await asyncio.sleep(0.01 / (len(self.log) + 1))
+        self.log.append((self.recipient_id, text))
+        self.sending = False
+
+
+class FakeConnection:
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+
+class FakeConnections:
+    def __init__(self, log, recipient_ids):
+        self.connections = {
+            recipient_id: [FakeConnection(FakeWebSocket(log, recipient_id))]
+            for recipient_id in recipient_ids
+        }
+
+    def user_connections(self, user_id):
+        return self.connections.get(user_id, [])
+
+    async def reap(self, connection):
+        pass
+
+
+def test_each_recipient_gets_notifications_in_order():
+    log = []
+
+    async def scenario():
+        dispatcher = NotificationDispatcher(lanes=2)
+        dispatcher.start(FakeConnections(log, [1, 2, 3]))
+        for index in range(5):
+            for recipient_id in (1, 2, 3):
+                dispatcher.enqueue(recipient_id, str(index))
+        while dispatcher.dispatched < 15:
+            await asyncio.sleep(0.01)
+        for task in dispatcher.worker_tasks:
+            task.cancel()
+        return dispatcher
+
+    dispatcher = asyncio.run(scenario())
+    for recipient_id in (1, 2, 3):
+        texts = [text for user_id, text in log if user_id == recipient_id]
+        assert texts == ["0", "1", "2", "3", "4"]
+    assert dispatcher.metrics()["dispatched"] == 15
+
+
+def test_full_lane_drops_its_oldest_notification(monkeypatch):
+    monkeypatch.setattr(
+        notifications_module, "NOTIFICATION_OVERFLOW_POLICY", "drop_oldest"
+    )
+    dispatcher = NotificationDispatcher(max_size=4, lanes=2)
+    for index in range(3):
+        dispatcher.enqueue(2, str(index))
+    dispatcher.enqueue(1, "other lane")
+
+    assert [notification.text for notification in dispatcher.lane(2).queue] == [
+        "1",
+        "2",
+    ]
+    assert dispatcher.metrics()["queue_depth"] == 3
+    assert dispatcher.metrics()["dropped"] == 1
+
+
+def test_ephemeral_notifications_never_push_out_messages():
+    log = []
+    dispatcher = NotificationDispatcher(max_size=2, lanes=1, max_ephemeral=2)
+    dispatcher.enqueue(1, "message")
+    for index in range(3):
+        dispatcher.enqueue(1, f"typing {index}", ephemeral=True)
+    dispatcher.enqueue(1, "later message")
+
+    metrics = dispatcher.metrics()
+    assert (metrics["queue_depth"], metrics["ephemeral_depth"]) == (2, 2)
+    assert (metrics["dropped"], metrics["ephemeral_dropped"]) == (0, 1)
+
+    async def scenario():
+        dispatcher.start(FakeConnections(log, [1]))
+        while dispatcher.dispatched < 4:
+            await asyncio.sleep(0.01)
+        for task in dispatcher.worker_tasks:
+            task.cancel()
+
+    asyncio.run(scenario())
+    # Delivered in the order they were queued
+    assert [text for _, text in log] == [
+        "message",
+        "typing 1",
+        "typing 2",
+        "later message",
+    ]
@@ -0,0 +1,64 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import insert
+from sqlalchemy.orm import sessionmaker
+
+from src import crud, models
+from src import presence as presence_module
+from src.presence import PresenceTracker
+
+from .seed import START, add_users
+
+
+@pytest.fixture
+def workers(engine, db, monkeypatch):
+    monkeypatch.setattr(
+        presence_module, "SessionLocal", sessionmaker(bind=engine, autoflush=False)
+    )
+    add_users(db, [1, 2])
+    return PresenceTracker(worker_id="a:1"), PresenceTracker(worker_id="b:1")
+
+
+def is_online(db, user_id):
+    db.expire_all()
+    return crud.get_users_online(db=db, user_ids=[user_id])[user_id]
+
+
+def test_user_stays_online_while_connected_to_another_worker(db, workers):
+    worker_a, worker_b = workers
+    worker_a.mark_online(1)
+    worker_b.mark_online(1)
+    asyncio.run(worker_a.flush())
+    asyncio.run(worker_b.flush())
+    assert is_online(db, 1)
+
+    worker_b.mark_offline(1)
+    asyncio.run(worker_b.flush())
+    assert is_online(db, 1)
+    assert worker_b.lookup(db, [1]) == {1: True}
+
+    worker_a.mark_offline(1)
+    asyncio.run(worker_a.flush())
+    assert not is_online(db, 1)
+
+
+def test_users_of_a_dead_worker_expire(db, workers):
+    worker_a, _ = workers
+    db.execute(
+        insert(models.UserPresence).values(user_id=2, worker_id="dead:1", seen_at=START)
+    )
+    db.query(models.User).filter(models.User.id == 2).update({"is_online": True})
+    db.commit()
+
+    states = crud.update_presence(
+        db=db,
+        worker_id="a:1",
+        online_ids=[1],
+        offline_ids=[],
+        seen_at=START + timedelta(hours=1),
+        expired_before=START + timedelta(minutes=1),
+    )
+    assert states == {1: True, 2: False}
+    assert not is_online(db, 2)
@@ -0,0 +1,106 @@
+import logging
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from src import crud, query_counter
+from src.query_counter import assert_constant_query_count, count_queries
+
+from .seed import add_friendship, add_users
+
+
+def test_count_queries(db):
+    with count_queries() as stats:
+        db.execute(text("SELECT 1"))
+        db.execute(text("SELECT 2"))
+    assert stats.count == 2
+    assert stats.total_time > 0
+
+
+def test_n_plus_one_is_detected(db):
+    def seed(size):
+        add_users(db, range(size * 100, size * 100 + size))
+
+    def run():
+        for user in crud.get_many_users(db=db, how_many=1000):
+            crud.get_user(db=db, user_id=user.id)
+
+    with pytest.raises(AssertionError, match="grows with data size"):
+        assert_constant_query_count(run, seed)
+
+
+def test_get_user_friends_query_count_is_constant(db):
+    add_users(db, [1])
+    next_id = iter(range(2, 1000))
+
+    def seed(size):
+        while len(crud.get_user_friends(db=db, this_user=1)) < size:
+            friend_id = next(next_id)
+            add_users(db, [friend_id])
+            add_friendship(db, friend_id, 1)
+            # Requested or denied friendships don't count, but are still read
+            other_id = next(next_id)
+            add_users(db, [other_id])
+            add_friendship(db, 1, other_id, status_codes=("R", "D"))
+
+    counts = assert_constant_query_count(
+        lambda: crud.get_user_friends(db=db, this_user=1), seed
+    )
+    assert set(counts.values()) == {2}
+
+
+def test_get_user_friends(db):
+    add_users(db, [1, 2, 3, 4, 5])
+    add_friendship(db, 1, 2)
+    add_friendship(db, 3, 1)
+    add_friendship(db, 1, 4, status_codes=("R",))
+    add_friendship(db, 5, 1, status_codes=("R", "A", "B"))
+
+    friends = crud.get_user_friends(db=db, this_user=1)
+    assert sorted(user.id for user in friends) == [2, 3, 5]
+
+
+def test_streamed_body_queries_are_counted(engine, monkeypatch, caplog):
+    monkeypatch.setattr(query_counter, "QUERY_BUDGET", 3)
+    app = FastAPI()
+    app.middleware("http")(query_counter.query_counter_middleware)
+
+    @app.get("/stream/")
+    def stream():
+        def rows():
+            with engine.connect() as connection:
+                for i in range(5):
+                    yield str(connection.execute(text(f"SELECT {i}")).scalar())
+
+        return StreamingResponse(rows())
+
+    with caplog.at_level(logging.WARNING, logger=query_counter.__name__):
+        response = TestClient(app).get("/stream/")
+
+    assert response.text == "01234"
+    assert "GET /stream/ issued 5 queries" in caplog.text
+
+
+def test_route_query_count_is_constant(db, engine, monkeypatch):
+    main = pytest.importorskip("src.main")
+    monkeypatch.setattr(query_counter, "QUERY_DEBUG_HEADERS", True)
+    main.app.dependency_overrides[main.get_read_db] = lambda: db
+    add_users(db, [1, 2])
+    try:
+        client = TestClient(main.app)
+
+        def seed(size):
+            while len(crud.get_user_received_messages(db=db, user_id=1)) < size:
+                crud.create_message(
+                    db=db,
+                    message=crud.schemas.MessageCreate(content="hi"),
+                    sender_id=2,
+                    receiver_id=1,
+                )
+
+        assert_constant_query_count(lambda: client.get("/users/1/messages/"), seed)
+    finally:
+        main.app.dependency_overrides.clear()
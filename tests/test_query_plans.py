@@ -0,0 +1,202 @@
+# Query plan regression checks for the hot crud queries.
+#
+# Seeds a realistic dataset inside a transaction that is rolled back at the
+# end, runs EXPLAIN (FORMAT JSON) on each query and checks the plan shape and
+# cost. Needs an empty PostgreSQL database set aside for tests:
+#
+#     TEST_DATABASE_URL=postgresql://.../snailmail_test python -m pytest
+
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Callable
+
+import pytest
+from sqlalchemy import create_engine, func, insert, text
+from sqlalchemy.orm import Query, Session
+
+from src import crud, migrations, models
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+SEED_USERS = 2000
+SEED_FRIENDS_PER_USER = 10
+SEED_MESSAGES_PER_FRIENDSHIP = 40
+SEED_BATCH_SIZE = 10000
+
+FORBIDDEN_NODES = {"Seq Scan", "Sort", "Incremental Sort"}
+INDEX_NODES = {"Index Scan", "Index Only Scan", "Bitmap Index Scan"}
+
+
+class PlanCheck:
+    def __init__(
+        self,
+        name: str,
+        build_query: Callable[[Session, int, int], Query],
+        max_cost: float,
+    ):
+        self.name = name
+        self.build_query = build_query
+        self.max_cost = max_cost
+
+
+PLAN_CHECKS = [
+    PlanCheck(
+        "get_friend_messages_sorted",
+        lambda db, user_id, friend_id: crud.query_friend_messages_sorted(
+            db=db, user_id=user_id, friend_id=friend_id
+        ),
+        max_cost=1000,
+    ),
+    PlanCheck(
+        "message_cache_freshness_check",
+        lambda db, user_id, friend_id: crud.query_friend_newest_message_id(
+            db=db, user_id=user_id, friend_id=friend_id
+        ),
+        max_cost=50,
+    ),
+    PlanCheck(
+        "get_friend_last_message",
+        lambda db, user_id, friend_id: crud.query_friend_last_message(
+            db=db, user_id=user_id, friend_id=friend_id
+        ).limit(1),
+        max_cost=50,
+    ),
+    PlanCheck(
+        "get_most_recent_friendship_status",
+        lambda db, user_id, friend_id: crud.query_most_recent_friendship_status(
+            db=db, requester_id=friend_id, adressee_id=user_id
+        ).limit(1),
+        max_cost=50,
+    ),
+    PlanCheck(
+        "get_friendship_requests_to_this_user",
+        lambda db, user_id, friend_id: crud.query_friendships_to_this_user(
+            db=db, this_user=user_id
+        ),
+        max_cost=100,
+    ),
+]
+
+
+def seed_dataset(db: Session):
+    rng = random.Random(1721)
+    start = datetime(2022, 1, 1)
+    # Explicit ids above anything already in the database
+    first_id = (db.query(func.max(models.User.id)).scalar() or 0) + 1
+    user_ids = range(first_id, first_id + SEED_USERS)
+
+    db.execute(
+        insert(models.User),
+        [
+            {"id": i, "user_email": f"plan-seed-{i}@example.com", "user_name": "seed"}
+            for i in user_ids
+        ],
+    )
+
+    pairs = set()
+    for requester in user_ids:
+        for adressee in rng.sample(user_ids, SEED_FRIENDS_PER_USER):
+            if requester != adressee and (adressee, requester) not in pairs:
+                pairs.add((requester, adressee))
+    pairs = sorted(pairs)
+
+    db.execute(
+        insert(models.Friendship),
+        [
+            {"requester_id": r, "adressee_id": a, "created_datetime": start}
+            for r, a in pairs
+        ],
+    )
+    db.execute(
+        insert(models.FriendshipStatus),
+        [
+            {
+                "requester_id": r,
+                "adressee_id": a,
+                "specifier_id": specifier,
+                "status_code": code,
+                "created_datetime": start + timedelta(minutes=offset),
+            }
+            for r, a in pairs
+            for offset, code, specifier in ((0, "R", r), (1, "A", a))
+        ],
+    )
+
+    batch = []
+    for r, a in pairs:
+        for i in range(SEED_MESSAGES_PER_FRIENDSHIP):
+            sender, receiver = (r, a) if rng.random() < 0.5 else (a, r)
+            batch.append(
+                {
+                    "content": "seed message",
+                    "sender_id": sender,
+                    "receiver_id": receiver,
+                    "created_datetime": start + timedelta(minutes=10 + i),
+                }
+            )
+            if len(batch) >= SEED_BATCH_SIZE:
+                db.execute(insert(models.Message), batch)
+                batch = []
+    if batch:
+        db.execute(insert(models.Message), batch)
+
+    db.execute(text("ANALYZE"))
+    return pairs
+
+
+def explain(db: Session, query: Query) -> dict:
+    compiled = query.statement.compile(
+        dialect=db.get_bind().dialect, compile_kwargs={"literal_binds": True}
+    )
+    return db.execute(text(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar()[0]["Plan"]
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def check_plan(check: PlanCheck, plan: dict) -> list[str]:
+    node_types = [node["Node Type"] for node in plan_nodes(plan)]
+    problems = []
+
+    forbidden = FORBIDDEN_NODES.intersection(node_types)
+    if forbidden:
+        problems.append(f"forbidden plan nodes: {', '.join(sorted(forbidden))}")
+    if not INDEX_NODES.intersection(node_types):
+        problems.append("no index scan in plan")
+    if plan["Total Cost"] > check.max_cost:
+        problems.append(f"total cost {plan['Total Cost']} > {check.max_cost}")
+
+    return problems
+
+
+@pytest.fixture(scope="module")
+def seeded_db():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    test_engine = create_engine(TEST_DATABASE_URL)
+    if test_engine.dialect.name != "postgresql":
+        pytest.skip("query plan checks need PostgreSQL")
+
+    with test_engine.connect() as connection:
+        transaction = connection.begin()
+        db = Session(bind=connection)
+        try:
+            models.Base.metadata.create_all(bind=connection)
+            migrations.add_conversation_pair_index(connection)
+            migrations.add_conversation_direction_index(connection)
+            yield db, seed_dataset(db)[0]
+        finally:
+            db.close()
+            transaction.rollback()
+    test_engine.dispose()
+
+
+@pytest.mark.parametrize("check", PLAN_CHECKS, ids=lambda check: check.name)
+def test_query_plan(seeded_db, check: PlanCheck):
+    db, (requester_id, adressee_id) = seeded_db
+    plan = explain(db, check.build_query(db, adressee_id, requester_id))
+    assert check_plan(check, plan) == []
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from src import rate_limit
+from src.rate_limit import InMemoryTokenBucketStore, RateLimit, TokenBucketStore
+
+
+@pytest.fixture
+def clock(fake_clock, monkeypatch):
+    fake_clock.install(monkeypatch, rate_limit)
+    return fake_clock
+
+
+def take(store, key="key", rate=1.0, capacity=3):
+    return asyncio.run(store.take(key, rate, capacity))
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        TokenBucketStore()
+
+
+def test_bucket_starts_full_and_refills(clock):
+    store = InMemoryTokenBucketStore()
+    assert [take(store) for _ in range(3)] == [0, 0, 0]
+    assert take(store) == pytest.approx(1.0)
+
+    clock.now += 0.5
+    assert take(store) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert take(store) == 0
+
+
+def test_refill_is_capped_at_capacity(clock):
+    store = InMemoryTokenBucketStore()
+    take(store)
+    clock.now += 100
+    assert [take(store) for _ in range(3)] == [0, 0, 0]
+    assert take(store) > 0
+
+
+def test_buckets_are_independent_and_bounded(clock):
+    store = InMemoryTokenBucketStore(max_buckets=2)
+    for _ in range(3):
+        take(store, key="a")
+    assert take(store, key="b") == 0
+
+    take(store, key="c")
+    assert list(store.buckets) == ["b", "c"]
+    # An evicted bucket starts full again
+    assert take(store, key="a") == 0
+
+
+def make_request(host="10.0.0.1", authorization="Bearer token"):
+    headers = [(b"authorization", authorization.encode())] if authorization else []
+    return Request(
+        {
+            "type": "http",
+            "method": "POST",
+            "path": "/",
+            "headers": headers,
+            "client": (host, 1234),
+        }
+    )
+
+
+def test_rate_limit_rejects_with_retry_after(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, "store", InMemoryTokenBucketStore())
+    limit = RateLimit(
+        "test", user_rate=0.5, user_capacity=2, ip_rate=10, ip_capacity=10
+    )
+
+    asyncio.run(limit(make_request()))
+    asyncio.run(limit(make_request()))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(limit(make_request()))
+    assert error.value.status_code == 429
+    assert error.value.headers == {"Retry-After": "2"}
+
+    # Another token, same address
+    asyncio.run(limit(make_request(authorization="Bearer other")))
+
+
+def test_rate_limit_per_ip(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, "store", InMemoryTokenBucketStore())
+    limit = RateLimit("test", user_rate=10, user_capacity=10, ip_rate=1, ip_capacity=1)
+
+    asyncio.run(limit(make_request(authorization=None)))
+    with pytest.raises(HTTPException):
+        asyncio.run(limit(make_request(authorization="Bearer other")))
+    asyncio.run(limit(make_request(host="10.0.0.2")))
+
+
+def test_websocket_frames_share_the_http_buckets(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, "store", InMemoryTokenBucketStore())
+    limit = RateLimit("test", user_rate=1, user_capacity=2, ip_rate=10, ip_capacity=10)
+    user_key = rate_limit.authorization_key("Bearer token")
+
+    asyncio.run(limit(make_request()))
+    assert asyncio.run(limit.take(ip="10.0.0.2", user_key=user_key)) == 0
+    assert asyncio.run(limit.take(ip="10.0.0.2", user_key=user_key)) > 0
+    with pytest.raises(HTTPException):
+        asyncio.run(limit(make_request()))
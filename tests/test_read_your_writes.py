@@ -0,0 +1,70 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine
+
+from src import database
+from src.database import (
+    READ_YOUR_WRITES_COOKIE,
+    READ_YOUR_WRITES_WINDOW,
+    ReadSessionLocal,
+    ReplicaRouter,
+    record_write,
+)
+
+
+def test_write_sets_cookie_and_next_read_goes_to_primary():
+    fastapi = pytest.importorskip("fastapi")
+    from fastapi.testclient import TestClient
+
+    app = fastapi.FastAPI()
+    app.middleware("http")(database.read_your_writes_middleware)
+
+    @app.post("/write/")
+    def write():
+        record_write(1)
+        return {}
+
+    @app.get("/read/")
+    def read(request: fastapi.Request):
+        return {"primary": database.client_wrote_recently(request)}
+
+    # The cookie is Secure, it is only sent back over https
+    client = TestClient(app, base_url="https://testserver")
+    assert READ_YOUR_WRITES_COOKIE not in client.get("/read/").cookies
+    assert client.get("/read/").json() == {"primary": False}
+
+    response = client.post("/write/")
+    assert READ_YOUR_WRITES_COOKIE in response.cookies
+    set_cookie = response.headers["set-cookie"].lower()
+    assert "samesite=none" in set_cookie and "secure" in set_cookie
+    assert client.get("/read/").json() == {"primary": True}
+
+
+def test_stale_future_or_malformed_cookie_is_ignored():
+    class FakeRequest:
+        def __init__(self, value):
+            self.cookies = {READ_YOUR_WRITES_COOKIE: value}
+
+    expired = time.time() - READ_YOUR_WRITES_WINDOW - 1
+    assert database.client_wrote_recently(FakeRequest(str(time.time())))
+    assert not database.client_wrote_recently(FakeRequest(str(expired)))
+    future = time.time() + 3600
+    assert not database.client_wrote_recently(FakeRequest(str(future)))
+    assert not database.client_wrote_recently(FakeRequest("not a time"))
+
+
+def test_primary_flag_bypasses_replicas(monkeypatch):
+    router = ReplicaRouter([])
+    replica_engine = create_engine("sqlite://")
+    router.engines.append(replica_engine)
+    monkeypatch.setattr(database, "replica_router", router)
+
+    db = ReadSessionLocal()
+    assert db.get_bind() is replica_engine
+    db.close()
+
+    db = ReadSessionLocal()
+    db.info["primary"] = True
+    assert db.get_bind() is database.engine
+    db.close()
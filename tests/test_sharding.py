@@ -0,0 +1,116 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import insert
+
+from src import crud, migrations, models
+from src.message_cache import MessageCache
+from src.sharding import ShardSet, merge_by_time
+
+from .seed import START, add_users
+
+SHARD_COUNT = 3
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    shard_set = ShardSet(
+        [f"sqlite:///{tmp_path / f'shard{index}.db'}" for index in range(SHARD_COUNT)]
+    )
+    monkeypatch.setattr(crud, "shards", shard_set)
+    monkeypatch.setattr(migrations, "shards", shard_set)
+    monkeypatch.setattr(crud, "message_cache", MessageCache())
+    for shard_index, shard_engine in enumerate(shard_set.engines):
+        migrations.run_migrations(
+            engine=shard_engine,
+            migrations=migrations.SHARD_MIGRATIONS,
+            shard_index=shard_index,
+        )
+    yield shard_set
+    for shard_engine in shard_set.engines:
+        shard_engine.dispose()
+
+
+def count_messages(session):
+    return session.query(models.Message).count()
+
+
+def test_merge_by_time_merges_ordered_results():
+    def messages(*minutes):
+        return [
+            SimpleNamespace(
+                id=minute, created_datetime=START + timedelta(minutes=minute)
+            )
+            for minute in minutes
+        ]
+
+    merged = merge_by_time([messages(1, 4, 6), messages(), messages(2, 3, 7)])
+    assert [message.id for message in merged] == [1, 2, 3, 4, 6, 7]
+
+
+def test_messages_are_written_to_the_shard_of_their_conversation(db, shards):
+    add_users(db, range(1, 8))
+    friend_ids = range(2, 8)
+    crud.create_messages(
+        db=db,
+        messages=[
+            {"content": f"to {friend_id}", "sender_id": 1, "receiver_id": friend_id}
+            for friend_id in friend_ids
+        ],
+    )
+
+    assert count_messages(db) == 0
+    for index in range(SHARD_COUNT):
+        shard_db = shards.open_session(index)
+        try:
+            expected = [
+                friend_id
+                for friend_id in friend_ids
+                if shards.shard_index(1, friend_id) == index
+            ]
+            receivers = [
+                message.receiver_id for message in shard_db.query(models.Message)
+            ]
+            assert sorted(receivers) == expected
+        finally:
+            shard_db.close()
+
+    messages = crud.get_friend_messages_sorted(db=db, user_id=4, friend_id=1, limit=10)
+    assert [message.content for message in messages] == ["to 4"]
+
+
+def test_reads_across_shards_are_merged_by_time(db, shards):
+    add_users(db, range(1, 8))
+    # Conversations of user 1 spread over the shards, written out of order
+    for minute, friend_id in enumerate([5, 2, 7, 3, 6, 4]):
+        with shards.session_for(db, 1, friend_id) as shard_db:
+            shard_db.execute(
+                insert(models.Message).values(
+                    content=str(minute),
+                    sender_id=friend_id,
+                    receiver_id=1,
+                    created_datetime=START + timedelta(minutes=minute),
+                )
+            )
+            shard_db.commit()
+    assert len({shards.shard_index(1, friend_id) for friend_id in range(2, 8)}) > 1
+
+    received = crud.get_user_received_messages(db=db, user_id=1)
+    assert [message.content for message in received] == ["0", "1", "2", "3", "4", "5"]
+    streamed = crud.iter_user_received_messages(db=db, user_id=1, batch_size=2)
+    assert [message.content for message in streamed] == ["0", "1", "2", "3", "4", "5"]
+
+    users = crud.get_users_with_messages(
+        db=db, users=[crud.get_user(db=db, user_id=user_id) for user_id in (1, 5)]
+    )
+    assert [message.content for message in users[0].received_messages] == [
+        "0",
+        "1",
+        "2",
+        "3",
+        "4",
+        "5",
+    ]
+    assert users[0].sent_messages == []
+    assert [message.content for message in users[1].sent_messages] == ["0"]
@@ -0,0 +1,114 @@
+import json
+import zlib
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.testclient import TestClient
+
+from src import crud, schemas, streaming
+from src.streaming import compress, negotiate_encoding, stream_models
+
+from .seed import add_users
+
+
+def test_negotiate_encoding(monkeypatch):
+    monkeypatch.setattr(streaming, "brotli", None)
+    assert negotiate_encoding("gzip, deflate, br") == "gzip"
+    assert negotiate_encoding("br") is None
+    assert negotiate_encoding("gzip;q=0, deflate") is None
+    assert negotiate_encoding("GZIP;q=0.5") == "gzip"
+    assert negotiate_encoding("") is None
+
+    monkeypatch.setattr(streaming, "brotli", object())
+    assert negotiate_encoding("gzip, br") == "br"
+    assert negotiate_encoding("gzip, br;q=0") == "gzip"
+
+
+def test_gzip_stream_is_one_valid_member():
+    chunks = [f"chunk {index}\n".encode() * 100 for index in range(20)]
+    compressed = b"".join(compress(iter(chunks), "gzip"))
+    assert compressed[:2] == b"\x1f\x8b"
+    assert zlib.decompress(compressed, wbits=31) == b"".join(chunks)
+
+
+def test_brotli_stream_round_trips():
+    brotli = pytest.importorskip("brotli")
+    chunks = [f"chunk {index}\n".encode() * 100 for index in range(20)]
+    compressed = b"".join(compress(iter(chunks), "br"))
+    assert brotli.decompress(compressed) == b"".join(chunks)
+
+
+@pytest.fixture
+def client(db):
+    add_users(db, [1, 2])
+    crud.create_messages(
+        db=db,
+        messages=[
+            {
+                "content": f"message {index}",
+                "sender_id": 1 + index % 2,
+                "receiver_id": 2 - index % 2,
+            }
+            for index in range(7)
+        ],
+    )
+    app = FastAPI()
+
+    @app.get("/history/")
+    def history(request: Request, stream: bool = False):
+        if stream:
+            return stream_models(
+                request,
+                crud.iter_friend_messages_sorted(
+                    db=db, user_id=1, friend_id=2, batch_size=3
+                ),
+                schemas.Message,
+                prefix='{"from_user_id": 2, "all_messages": ',
+                suffix="}",
+            )
+        messages = crud.get_friend_messages_sorted(db=db, user_id=1, friend_id=2)
+        return {
+            "from_user_id": 2,
+            "all_messages": [schemas.Message.from_orm(message) for message in messages],
+        }
+
+    return TestClient(app)
+
+
+def raw_body(response) -> bytes:
+    return response.raw.read(decode_content=False)
+
+
+def test_streamed_history_matches_the_plain_response(client):
+    expected = jsonable_encoder(client.get("/history/").json())
+    assert len(expected["all_messages"]) == 7
+
+    response = client.get(
+        "/history/",
+        params={"stream": True},
+        headers={"Accept-Encoding": "gzip"},
+        stream=True,
+    )
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    body = zlib.decompress(raw_body(response), wbits=31)
+    assert json.loads(body) == expected
+
+    response = client.get(
+        "/history/", params={"stream": True}, headers={"Accept-Encoding": "identity"}
+    )
+    assert "Content-Encoding" not in response.headers
+    assert response.json() == expected
+
+
+def test_ndjson_stream_has_one_message_per_line(client):
+    expected = client.get("/history/").json()["all_messages"]
+    response = client.get(
+        "/history/",
+        params={"stream": True},
+        headers={"Accept": streaming.NDJSON_MEDIA_TYPE, "Accept-Encoding": "identity"},
+    )
+    assert response.headers["content-type"] == streaming.NDJSON_MEDIA_TYPE
+    lines = response.text.splitlines()
+    assert [json.loads(line) for line in lines] == expected
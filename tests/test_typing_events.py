@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+from src import typing_events as typing_events_module
+from src.typing_events import TypingEvents
+
+
+class FakeNotifications:
+    def __init__(self):
+        self.sent = []
+
+    def enqueue(self, recipient_id, text, ephemeral=False):
+        assert ephemeral
+        self.sent.append((recipient_id, json.loads(text)["typing"]))
+
+
+class FakeConnections:
+    def __init__(self, online_ids):
+        self.online_ids = online_ids
+
+    def user_connections(self, user_id):
+        return [object()] if user_id in self.online_ids else []
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    fake_notifications = FakeNotifications()
+    monkeypatch.setattr(typing_events_module, "notifications", fake_notifications)
+    monkeypatch.setattr(typing_events_module, "connections", FakeConnections({2}))
+    monkeypatch.setattr(typing_events_module, "TYPING_THROTTLE_INTERVAL", 0.05)
+    return fake_notifications.sent
+
+
+def test_changes_within_the_interval_are_coalesced(sent):
+    events = TypingEvents()
+
+    async def scenario():
+        events.publish(1, 2, True)
+        # Flickers within the interval end as one trailing event
+        events.publish(1, 2, False)
+        events.publish(1, 2, True)
+        events.publish(1, 2, False)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert sent == [(2, True), (2, False)]
+    assert events.metrics()["coalesced"] == 2
+
+
+def test_repeated_state_refreshes_after_the_interval(sent):
+    events = TypingEvents()
+
+    async def scenario():
+        events.publish(1, 2, True)
+        events.publish(1, 2, True)
+        await asyncio.sleep(0.06)
+        events.publish(1, 2, True)
+
+    asyncio.run(scenario())
+    assert sent == [(2, True), (2, True)]
+
+
+def test_message_cancels_the_pending_event(sent):
+    events = TypingEvents()
+
+    async def scenario():
+        events.publish(1, 2, True)
+        events.publish(1, 2, False)
+        events.message_sent(1, 2)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert sent == [(2, True)]
+    assert events.pairs == {}
+
+
+def test_recipient_without_sockets_gets_nothing(sent):
+    events = TypingEvents()
+    events.publish(1, 3, True)
+    assert sent == []
+
+
+def test_tracked_pairs_are_bounded(sent):
+    events = TypingEvents(max_pairs=2)
+
+    async def scenario():
+        for sender_id in (1, 3, 4):
+            events.publish(sender_id, 2, True)
+
+    asyncio.run(scenario())
+    assert list(events.pairs) == [(3, 2), (4, 2)]
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src import warmup as warmup_module
+from src.warmup import WarmupState
+
+
+@pytest.fixture(autouse=True)
+def no_retry_wait(monkeypatch):
+    monkeypatch.setattr(warmup_module, "WARMUP_RETRY_INTERVAL", 0)
+
+
+def flaky_step(failures: int):
+    calls = []
+
+    async def step():
+        calls.append(len(calls))
+        if len(calls) <= failures:
+            raise ConnectionError("not up yet")
+
+    return step, calls
+
+
+def test_failing_step_is_retried_until_it_succeeds():
+    state = WarmupState()
+    step, calls = flaky_step(failures=2)
+    state.step("flaky")(step)
+
+    async def ok():
+        pass
+
+    state.step("ok")(ok)
+    assert not state.ready
+    assert state.pending() == ["flaky", "ok"]
+
+    asyncio.run(state.run())
+    assert len(calls) == 3
+    assert state.ready
+    assert state.pending() == []
+    assert state.errors == {}
+
+
+def test_error_is_reported_while_the_step_is_failing():
+    state = WarmupState()
+    seen_errors = []
+
+    async def step():
+        seen_errors.append(dict(state.errors))
+        if len(seen_errors) == 1:
+            raise ConnectionError("not up yet")
+
+    state.step("flaky")(step)
+    asyncio.run(state.run())
+    # The retry runs while the first failure is still reported
+    assert seen_errors == [{}, {"flaky": "ConnectionError('not up yet')"}]
+    assert state.errors == {}
+
+
+def test_ready_endpoint_turns_200_once_warm(monkeypatch):
+    main = pytest.importorskip("src.main")
+    state = WarmupState()
+    step, _ = flaky_step(failures=1)
+    state.step("fief_jwks")(step)
+    monkeypatch.setattr(main, "warmup", state)
+    client = TestClient(main.app)
+
+    response = client.get("/ready/")
+    assert response.status_code == 503
+    assert response.json()["response_text"] == "warming up: fief_jwks"
+
+    asyncio.run(state.run())
+    assert client.get("/ready/").status_code == 200